@@ -0,0 +1,137 @@
+# admission.py
+import os
+import math
+import time
+import logging
+import threading
+import redis
+from dotenv import load_dotenv
+from cache import get_redis_client
+from celery_client import LANES
+from metrics import registry, queue_depths
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# A lane stops admitting jobs once this many are queued in it, or once a new job would wait longer than this
+ADMISSION_MAX_QUEUED = {
+    "interactive": int(os.getenv("ADMISSION_MAX_QUEUED_INTERACTIVE", 200)),
+    "bulk": int(os.getenv("ADMISSION_MAX_QUEUED_BULK", 2000)),
+}
+ADMISSION_MAX_WAIT_SECONDS = {
+    "interactive": float(os.getenv("ADMISSION_MAX_WAIT_SECONDS_INTERACTIVE", 300)),
+    "bulk": float(os.getenv("ADMISSION_MAX_WAIT_SECONDS_BULK", 3600)),
+}
+# Jobs the cluster works on at once (the I/O workers' total concurrency), to turn a backlog into a wait
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", 32))
+# Assumed duration of a job until finished jobs have been measured
+ADMISSION_DEFAULT_SERVICE_SECONDS = float(os.getenv("ADMISSION_DEFAULT_SERVICE_SECONDS", 60))
+# Weight of the latest job in the moving average of job durations
+ADMISSION_SERVICE_TIME_ALPHA = float(os.getenv("ADMISSION_SERVICE_TIME_ALPHA", 0.2))
+# Queue depths are read from Redis at most this often per API process
+ADMISSION_REFRESH_SECONDS = float(os.getenv("ADMISSION_REFRESH_SECONDS", 1))
+ADMISSION_MAX_RETRY_AFTER_SECONDS = 3600
+
+SERVICE_TIME_KEY = "admission:service_seconds"
+
+# Folds one job's duration into the exponentially weighted moving average kept for its mode
+SERVICE_TIME_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]))
+local sample = tonumber(ARGV[2])
+local alpha = tonumber(ARGV[3])
+if current then
+    sample = alpha * sample + (1 - alpha) * current
+end
+redis.call('HSET', KEYS[1], ARGV[1], sample)
+return tostring(sample)
+"""
+
+class AdmissionController:
+    """
+    Decides whether a lane can take more jobs from the live depth of its Celery queues and the recent
+    duration of jobs, and estimates when an admitted job will finish. Without Redis the queues cannot be
+    read, so every job is admitted.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._connected = False
+        self._local_service_seconds = {}
+        self._backlogs = {}
+        self._lock = threading.Lock()
+
+    def _redis(self):
+        with self._lock:
+            if not self._connected:
+                self._connected = True
+                self._client = get_redis_client("admission control")
+        return self._client
+
+    def record_service_time(self, mode: str, seconds: float):
+        """Adds a finished job's duration (from its start to its result) to the average for its mode."""
+        client = self._redis()
+        if client is not None:
+            try:
+                client.eval(SERVICE_TIME_SCRIPT, 1, SERVICE_TIME_KEY, mode, seconds, ADMISSION_SERVICE_TIME_ALPHA)
+                return
+            except redis.RedisError as e:
+                logger.warning(f"Could not record the job duration in Redis: {e}")
+        with self._lock:
+            current = self._local_service_seconds.get(mode)
+            self._local_service_seconds[mode] = seconds if current is None else (
+                ADMISSION_SERVICE_TIME_ALPHA * seconds + (1 - ADMISSION_SERVICE_TIME_ALPHA) * current
+            )
+
+    def service_time(self, mode: str) -> float:
+        client = self._redis()
+        if client is not None:
+            try:
+                value = client.hget(SERVICE_TIME_KEY, mode)
+                if value is not None:
+                    return float(value)
+            except redis.RedisError as e:
+                logger.warning(f"Could not read the job duration from Redis: {e}")
+        with self._lock:
+            return self._local_service_seconds.get(mode, ADMISSION_DEFAULT_SERVICE_SECONDS)
+
+    def backlog(self, lane: str) -> int:
+        """Messages waiting in the lane's CPU and I/O queues: roughly one per job waiting for its next step."""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._backlogs.get(lane)
+        if cached and now - cached[0] < ADMISSION_REFRESH_SECONDS:
+            return cached[1]
+        depth = sum(queue_depths(list(LANES[lane].values())).values())
+        with self._lock:
+            self._backlogs[lane] = (now, depth)
+        return depth
+
+    def admit(self, lane: str, mode: str, jobs: int = 1) -> dict:
+        """
+        Returns the decision for `jobs` new jobs in a lane: whether they are admitted, the estimated wait
+        and time to finish in seconds and, when they are not, how long to wait before retrying.
+        """
+        queued = self.backlog(lane)
+        service_seconds = self.service_time(mode)
+        wait_seconds = (queued + jobs - 1) * service_seconds / ADMISSION_CONCURRENCY
+        decision = {
+            "admitted": True,
+            "lane": lane,
+            "queued": queued,
+            "estimated_wait_seconds": round(wait_seconds),
+            "estimated_seconds": round(wait_seconds + service_seconds),
+        }
+
+        excess_jobs = queued + jobs - ADMISSION_MAX_QUEUED[lane]
+        excess_wait = wait_seconds - ADMISSION_MAX_WAIT_SECONDS[lane]
+        if excess_jobs > 0 or excess_wait > 0:
+            # Time for the workers to drain the excess at the current pace
+            drain_seconds = max(excess_jobs * service_seconds / ADMISSION_CONCURRENCY, excess_wait, 1)
+            decision["admitted"] = False
+            decision["retry_after_seconds"] = min(math.ceil(drain_seconds), ADMISSION_MAX_RETRY_AFTER_SECONDS)
+            registry.inc("admission_rejections_total", lane=lane)
+            logger.warning(f"Rejected {jobs} job(s) in the {lane} lane: {queued} queued, ~{wait_seconds:.0f}s wait.")
+        return decision
+
+admission = AdmissionController()
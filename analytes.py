@@ -0,0 +1,250 @@
+# analytes.py
+import re
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# A report must contain at least this many recognized analytes to count as a blood test report
+MIN_RECOGNIZED_ANALYTES = 3
+
+# Canonical analytes: aliases as printed by common labs, and a fallback adult reference range
+# used only when the report itself doesn't print one (and the units match).
+CANONICAL_ANALYTES = {
+    "Hemoglobin": {"aliases": ["haemoglobin", "hb", "hgb"], "unit": "g/dL", "low": 12.0, "high": 17.0},
+    "Hematocrit": {"aliases": ["packed cell volume", "pcv", "hct", "haematocrit"], "unit": "%", "low": 36.0, "high": 50.0},
+    "RBC Count": {"aliases": ["rbc", "red blood cell count", "total rbc count", "erythrocyte count"], "unit": "mill/mm3", "low": 4.0, "high": 5.9},
+    "MCV": {"aliases": ["mean corpuscular volume"], "unit": "fL", "low": 83.0, "high": 101.0},
+    "MCH": {"aliases": ["mean corpuscular hemoglobin"], "unit": "pg", "low": 27.0, "high": 32.0},
+    "MCHC": {"aliases": ["mean corpuscular hemoglobin concentration"], "unit": "g/dL", "low": 31.5, "high": 34.5},
+    "RDW": {"aliases": ["red cell distribution width", "rdw cv", "rdw-cv"], "unit": "%", "low": 11.6, "high": 14.0},
+    "WBC Count": {"aliases": ["total leukocyte count", "tlc", "wbc", "total wbc count", "white blood cell count"], "unit": "thou/mm3", "low": 4.0, "high": 10.0},
+    "Neutrophils": {"aliases": ["segmented neutrophils", "polymorphs"], "unit": "%", "low": 40.0, "high": 80.0},
+    "Lymphocytes": {"aliases": [], "unit": "%", "low": 20.0, "high": 40.0},
+    "Monocytes": {"aliases": [], "unit": "%", "low": 2.0, "high": 10.0},
+    "Eosinophils": {"aliases": [], "unit": "%", "low": 1.0, "high": 6.0},
+    "Basophils": {"aliases": [], "unit": "%", "low": 0.0, "high": 2.0},
+    "Platelet Count": {"aliases": ["platelets", "plt"], "unit": "thou/mm3", "low": 150.0, "high": 410.0},
+    "Mean Platelet Volume": {"aliases": ["mpv"], "unit": "fL", "low": 6.5, "high": 12.0},
+    "ESR": {"aliases": ["erythrocyte sedimentation rate"], "unit": "mm/hr", "low": 0.0, "high": 15.0},
+    "Glucose, Fasting": {"aliases": ["glucose fasting", "fasting blood sugar", "fbs", "fasting glucose"], "unit": "mg/dL", "low": 70.0, "high": 100.0},
+    "HbA1c": {"aliases": ["glycosylated hemoglobin", "glycated hemoglobin", "a1c"], "unit": "%", "low": 4.0, "high": 5.6},
+    "Total Cholesterol": {"aliases": ["cholesterol total", "cholesterol", "serum cholesterol"], "unit": "mg/dL", "low": None, "high": 200.0},
+    "HDL Cholesterol": {"aliases": ["hdl", "hdl c"], "unit": "mg/dL", "low": 40.0, "high": None},
+    "LDL Cholesterol": {"aliases": ["ldl", "ldl c", "ldl cholesterol calculated", "ldl cholesterol direct"], "unit": "mg/dL", "low": None, "high": 100.0},
+    "VLDL Cholesterol": {"aliases": ["vldl", "vldl cholesterol calculated"], "unit": "mg/dL", "low": None, "high": 30.0},
+    "Non-HDL Cholesterol": {"aliases": ["non hdl cholesterol", "non hdl c"], "unit": "mg/dL", "low": None, "high": 130.0},
+    "Triglycerides": {"aliases": ["tg", "triglyceride"], "unit": "mg/dL", "low": None, "high": 150.0},
+    "Creatinine": {"aliases": ["serum creatinine"], "unit": "mg/dL", "low": 0.7, "high": 1.3},
+    "eGFR": {"aliases": ["gfr estimated", "estimated gfr", "gfr"], "unit": "mL/min/1.73m2", "low": 60.0, "high": None},
+    "Urea": {"aliases": ["blood urea", "serum urea"], "unit": "mg/dL", "low": 13.0, "high": 43.0},
+    "BUN": {"aliases": ["urea nitrogen blood", "blood urea nitrogen"], "unit": "mg/dL", "low": 6.0, "high": 20.0},
+    "Uric Acid": {"aliases": ["serum uric acid"], "unit": "mg/dL", "low": 3.5, "high": 7.2},
+    "AST": {"aliases": ["sgot", "aspartate aminotransferase"], "unit": "U/L", "low": 15.0, "high": 40.0},
+    "ALT": {"aliases": ["sgpt", "alanine aminotransferase"], "unit": "U/L", "low": 10.0, "high": 49.0},
+    "GGT": {"aliases": ["ggtp", "gamma glutamyl transferase"], "unit": "U/L", "low": 0.0, "high": 73.0},
+    "Alkaline Phosphatase": {"aliases": ["alp"], "unit": "U/L", "low": 30.0, "high": 120.0},
+    "Bilirubin, Total": {"aliases": ["bilirubin total", "total bilirubin"], "unit": "mg/dL", "low": 0.3, "high": 1.2},
+    "Bilirubin, Direct": {"aliases": ["bilirubin direct", "direct bilirubin"], "unit": "mg/dL", "low": None, "high": 0.3},
+    "Bilirubin, Indirect": {"aliases": ["bilirubin indirect", "indirect bilirubin"], "unit": "mg/dL", "low": None, "high": 1.1},
+    "Total Protein": {"aliases": ["protein total", "serum protein"], "unit": "g/dL", "low": 5.7, "high": 8.2},
+    "Albumin": {"aliases": ["serum albumin"], "unit": "g/dL", "low": 3.2, "high": 4.8},
+    "Globulin": {"aliases": [], "unit": "g/dL", "low": 2.0, "high": 3.5},
+    "A:G Ratio": {"aliases": ["a g ratio", "albumin globulin ratio"], "unit": None, "low": 0.9, "high": 2.0},
+    "Calcium": {"aliases": ["calcium total", "serum calcium"], "unit": "mg/dL", "low": 8.7, "high": 10.4},
+    "Phosphorus": {"aliases": ["phosphate", "inorganic phosphorus"], "unit": "mg/dL", "low": 2.4, "high": 5.1},
+    "Sodium": {"aliases": ["na", "serum sodium"], "unit": "mEq/L", "low": 136.0, "high": 145.0},
+    "Potassium": {"aliases": ["k", "serum potassium"], "unit": "mEq/L", "low": 3.5, "high": 5.1},
+    "Chloride": {"aliases": ["cl", "serum chloride"], "unit": "mEq/L", "low": 98.0, "high": 107.0},
+    "T3, Total": {"aliases": ["t3 total", "total t3", "t3", "triiodothyronine"], "unit": "ng/mL", "low": 0.6, "high": 1.81},
+    "T4, Total": {"aliases": ["t4 total", "total t4", "t4", "thyroxine"], "unit": "µg/dL", "low": 5.01, "high": 12.45},
+    "TSH": {"aliases": ["thyroid stimulating hormone", "tsh ultrasensitive"], "unit": "µIU/mL", "low": 0.55, "high": 4.78},
+    "Vitamin D": {"aliases": ["vitamin d 25 hydroxy", "25 oh vitamin d", "vitamin d total", "25 hydroxy vitamin d"], "unit": "nmol/L", "low": 75.0, "high": 250.0},
+    "Vitamin B12": {"aliases": ["cyanocobalamin", "vitamin b12 cyanocobalamin"], "unit": "pg/mL", "low": 211.0, "high": 911.0},
+    "Iron": {"aliases": ["serum iron"], "unit": "µg/dL", "low": 65.0, "high": 175.0},
+    "Ferritin": {"aliases": ["serum ferritin"], "unit": "ng/mL", "low": 22.0, "high": 322.0},
+    "CRP": {"aliases": ["c reactive protein", "hs crp", "hscrp"], "unit": "mg/L", "low": None, "high": 5.0},
+}
+
+def _normalize(name: str) -> str:
+    return re.sub(r"[^a-z0-9µ]+", " ", name.lower()).strip()
+
+# Normalized name or alias -> canonical name, built once at import
+ANALYTE_INDEX = {}
+for _canonical, _info in CANONICAL_ANALYTES.items():
+    for _alias in [_canonical] + _info["aliases"]:
+        ANALYTE_INDEX[_normalize(_alias)] = _canonical
+
+# Specimen suffixes labs append to test names, e.g. "Vitamin D, 25 - Hydroxy, Serum"
+SPECIMEN_SUFFIX = re.compile(r"\s+(?:serum|plasma|whole blood|blood)$")
+
+_NUMBER = r"\d+(?:\.\d+)?"
+# "Hemoglobin 15.00 g/dL 13.00 - 17.00", "Basophils 0.00 % <2.00", "A : G Ratio 1.33 0.90 - 2.00"
+RESULT_LINE = re.compile(
+    rf"^(?P<name>[A-Za-z][^|]*?)\s+(?P<value>{_NUMBER})(?:\s+(?P<unit>[^\s\d][^\s]*))?"
+    rf"\s+(?P<range>[<>]=?\s*{_NUMBER}|{_NUMBER}\s*-\s*{_NUMBER})\s*$"
+)
+RANGE = re.compile(rf"^\s*(?:(?P<low>{_NUMBER})\s*-\s*(?P<high>{_NUMBER})|(?P<op>[<>])=?\s*(?P<bound>{_NUMBER}))\s*$")
+# "Collected : 14/5/2023 11:03:00AM", "Sample Date: 2023-05-14". Numeric dates are read day first, as labs print them
+COLLECTION_DATE = re.compile(
+    r"(?:collected|collection date|sample date|sampled on)\s*(?:on)?\s*:?\s*"
+    r"(?:(?P<day>\d{1,2})[/.-](?P<month>\d{1,2})[/.-](?P<year>\d{4})|(?P<iso>\d{4}-\d{2}-\d{2}))",
+    re.IGNORECASE
+)
+
+def lookup_analyte(name: str):
+    """Returns the canonical analyte name for a printed test name, or None if it isn't indexed."""
+    normalized = _normalize(name)
+    if normalized in ANALYTE_INDEX:
+        return ANALYTE_INDEX[normalized]
+    without_specimen = SPECIMEN_SUFFIX.sub("", normalized)
+    if without_specimen in ANALYTE_INDEX:
+        return ANALYTE_INDEX[without_specimen]
+    # "Packed Cell Volume (PCV)", "AST (SGOT)": try the name without, then the text inside, the parentheses
+    outer = _normalize(re.sub(r"\(.*?\)", " ", name))
+    if outer in ANALYTE_INDEX:
+        return ANALYTE_INDEX[outer]
+    for inner in re.findall(r"\((.*?)\)", name):
+        if _normalize(inner) in ANALYTE_INDEX:
+            return ANALYTE_INDEX[_normalize(inner)]
+    return None
+
+def parse_reference_range(text: str):
+    """Parses "13.00 - 17.00", "<200.00" or ">40" into a (low, high) pair; either bound may be None."""
+    match = RANGE.match(text or "")
+    if not match:
+        return None, None
+    if match.group("op") == "<":
+        return None, float(match.group("bound"))
+    if match.group("op") == ">":
+        return float(match.group("bound")), None
+    return float(match.group("low")), float(match.group("high"))
+
+def _make_record(name: str, value: str, unit: str, reference: str):
+    canonical = lookup_analyte(name)
+    low, high = parse_reference_range(reference)
+    if low is None and high is None and canonical:
+        # Fall back to the indexed range, but only when it is expressed in the same units
+        info = CANONICAL_ANALYTES[canonical]
+        if info["unit"] == (unit or None):
+            low, high = info["low"], info["high"]
+
+    value = float(value)
+    if low is None and high is None:
+        flag = None
+    elif low is not None and value < low:
+        flag = "LOW"
+    elif high is not None and value > high:
+        flag = "HIGH"
+    else:
+        flag = "NORMAL"
+
+    return {
+        "name": name.strip(),
+        "analyte": canonical,
+        "value": value,
+        "unit": unit or None,
+        "low": low,
+        "high": high,
+        "flag": flag,
+    }
+
+def _records_from_tables(tables: list) -> list:
+    records = []
+    for table in tables or []:
+        for row in table:
+            if len(row) < 4 or any(not cell for cell in row[:4]):
+                continue
+            name, value, unit, reference = (cell.strip() for cell in row[:4])
+            # Rows that pack several results into one cell are left to the text parser
+            if "\n" in value:
+                continue
+            if re.fullmatch(_NUMBER, value) and RANGE.match(reference):
+                # The first line is the test name; the following ones name the method
+                records.append(_make_record(name.split("\n")[0], value, unit, reference))
+    return records
+
+def _records_from_text(text: str) -> list:
+    records = []
+    for line in (text or "").splitlines():
+        match = RESULT_LINE.match(line.strip())
+        if match:
+            records.append(_make_record(match.group("name"), match.group("value"), match.group("unit"), match.group("range")))
+    return records
+
+def parse_analytes(text: str, tables: list = None) -> list:
+    """
+    Turns the extracted text and tables of a report into analyte records:
+    name, canonical analyte, value, unit, reference range and a LOW/HIGH/NORMAL flag.
+    Table rows are preferred; text lines fill in what the tables missed.
+    """
+    records = []
+    seen = set()
+    for record in _records_from_tables(tables) + _records_from_text(text):
+        key = (_normalize(record["name"]), record["value"], record["unit"])
+        if key not in seen:
+            seen.add(key)
+            records.append(record)
+    return records
+
+def is_blood_report(records: list) -> bool:
+    """A report is accepted once it contains enough analytes from the canonical index."""
+    return len({record["analyte"] for record in records if record["analyte"]}) >= MIN_RECOGNIZED_ANALYTES
+
+def summarize_findings(records: list) -> dict:
+    """Builds the compact structure handed to the agents: every abnormal value, and only the names of the rest."""
+    abnormal = []
+    within_range = []
+    for record in records:
+        label = record["analyte"] or record["name"]
+        if record["flag"] in ("LOW", "HIGH"):
+            if record["low"] is None:
+                reference = f"<{record['high']:g}"
+            elif record["high"] is None:
+                reference = f">{record['low']:g}"
+            else:
+                reference = f"{record['low']:g}-{record['high']:g}"
+            abnormal.append({
+                "analyte": label,
+                "value": record["value"],
+                "unit": record["unit"],
+                "reference": reference,
+                "flag": record["flag"],
+            })
+        elif record["flag"] == "NORMAL":
+            within_range.append(label)
+    return {
+        "analytes_checked": len(records),
+        "abnormal": abnormal,
+        # Differential counts appear twice (% and absolute); list each name once
+        "within_range": list(dict.fromkeys(within_range)),
+    }
+
+def analyte_values(records: list) -> list:
+    """
+    Lists the value of every canonical analyte on the report, once per analyte and unit, with its
+    reference range: what is kept in the patient's analyte history.
+    """
+    values = {}
+    for record in records:
+        if record["analyte"]:
+            values.setdefault((record["analyte"], record["unit"]), {
+                "analyte": record["analyte"],
+                "value": record["value"],
+                "unit": record["unit"],
+                "low": record["low"],
+                "high": record["high"],
+            })
+    return list(values.values())
+
+def collection_date(text: str):
+    """Returns the date the report's sample was collected, or None when the report does not print one."""
+    match = COLLECTION_DATE.search(text or "")
+    if not match:
+        return None
+    try:
+        if match.group("iso"):
+            return datetime.strptime(match.group("iso"), "%Y-%m-%d")
+        return datetime(int(match.group("year")), int(match.group("month")), int(match.group("day")))
+    except ValueError:
+        return None
@@ -0,0 +1,252 @@
+# benchmarks/bench_e2e.py
+"""
+Offline end-to-end benchmark: POST /analyze -> process_report_task -> GET /result, with no network.
+
+Stand-ins for the external services:
+    Gemini     a deterministic fake LLM with configurable latency and completion length, patched in for
+               litellm.completion (the tools) and crewai's LLM.call (the agents, still behind the rate limiter)
+    Serper     the search tool's offline backend, the local knowledge index
+    Mongo      mongomock, in memory
+    Redis      fakeredis, one in-memory server per worker process, so the Redis cache tier, the Lua token
+               bucket, single-flight leases, metrics and progress pub/sub all run; Celery runs eagerly
+
+Each fake Redis is private to its process, so the bench does not measure what workers share through Redis
+(cross-process cache hits, one token bucket for all workers, leases held by another worker) or its network cost.
+
+Each of the `--concurrency` processes plays one prefork worker with its own API in front of it and
+works through its share of the jobs one at a time. Every job is a distinct synthetic report, so the
+result and LLM caches never short-circuit the pipeline.
+
+Usage:
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_e2e.py [--jobs 16] [--concurrency 1 4] [--pages 2 20] [--llm-latency 0.5] [--completion-tokens 300] [--mode full]
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+STAGES = ["verification", "doctor", "nutrition", "exercise", "compile"]
+
+VOCABULARY = (
+    "hemoglobin cholesterol vitamin iron intake levels range elevated reduced monitor recommend weekly diet "
+    "protein fibre hydration sleep walking strength mobility follow-up physician balanced moderate daily"
+).split()
+
+class FakeLLM:
+    """
+    Deterministic stand-in for Gemini. Replies are derived from a hash of the prompt, take
+    `latency` seconds, and are `completion_tokens` words long. Counts calls and (estimated) tokens.
+    """
+
+    def __init__(self, latency: float, completion_tokens: int):
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+        self.stats = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self._lock = threading.Lock()
+
+    def _reply(self, prompt: str) -> str:
+        rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["prompt_tokens"] += len(prompt) // 4
+            self.stats["completion_tokens"] += self.completion_tokens
+        time.sleep(self.latency)
+        return " ".join(rng.choice(VOCABULARY) for _ in range(self.completion_tokens))
+
+    def completion(self, model=None, messages=None, **kwargs):
+        """Replaces litellm.completion, returning a response shaped like LiteLLM's."""
+        prompt = "\n".join(str(message.get("content", "")) for message in messages or [])
+        content = self._reply(prompt)
+        usage = SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=self.completion_tokens)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+    def call(self, messages, *args, **kwargs) -> str:
+        """
+        Replaces crewai's LLM.call with a ReAct-style reply. When the task asks for one of the agent's
+        tools by name (e.g. "Use the 'Exercise Plan Tool'"), the first reply invokes it once, so the
+        tools' own LLM calls are exercised too; otherwise, and after the observation, it gives the final answer.
+        """
+        if isinstance(messages, str):
+            messages = [{"role": "user", "content": messages}]
+        prompt = "\n".join(str(message.get("content", "")) for message in messages)
+        answer = self._reply(prompt)
+
+        observed = any("Observation:" in str(m.get("content", "")) for m in messages if m.get("role") == "assistant")
+        if not observed:
+            for name in re.findall(r"Tool Name: (.+)", prompt):
+                name = name.strip()
+                if f"'{name}'" in prompt:
+                    argument = re.search(rf"Tool Name: {re.escape(name)}\nTool Arguments: {{'(\w+)'", prompt)
+                    action_input = json.dumps({argument.group(1) if argument else "input": answer})
+                    return f"Thought: I should use the {name}.\nAction: {name}\nAction Input: {action_input}"
+        return f"Thought: I now know the final answer\nFinal Answer: {answer}"
+
+def configure_offline_environment(work_dir: str):
+    """Points every setting at local stand-ins. Must run before the project modules are imported."""
+    os.environ.update({
+        # Empty values are kept by load_dotenv, so a local .env cannot point the run at real services
+        # Never connected to: every client comes from fakeredis, see below
+        "REDIS_URL": "redis://localhost:1/0",
+        "MONGO_URI": "",
+        "MONGO_DB_NAME": "bench",
+        "GEMINI_API_KEY": "offline",
+        "SEARCH_BACKEND": "local",
+        "CACHE_DIR": os.path.join(work_dir, "cache"),
+        "PDF_TEXT_CACHE_DIR": os.path.join(work_dir, "text_cache"),
+        "BLOB_DIR": os.path.join(work_dir, "blobs"),
+        "LLM_REQUESTS_PER_MINUTE": "100000",
+        "LLM_BURST": "1000",
+        "LITELLM_LOCAL_MODEL_COST_MAP": "True",
+        "CREWAI_DISABLE_TELEMETRY": "true",
+        "OTEL_SDK_DISABLED": "true",
+    })
+    import redis
+    import fakeredis
+    import mongomock
+    import pymongo
+    from mongomock.collection import BulkOperationBuilder
+
+    server = fakeredis.FakeServer()
+    redis.Redis.from_url = classmethod(lambda cls, url, **kwargs: fakeredis.FakeRedis(server=server))
+    pymongo.MongoClient = lambda *args, **kwargs: mongomock.MongoClient()
+    # pymongo 4.11+ passes `sort` to bulk updates and replacements, which mongomock does not accept yet
+    for name in ("add_update", "add_replace"):
+        method = getattr(BulkOperationBuilder, name)
+        setattr(BulkOperationBuilder, name, lambda self, *args, sort=None, _method=method, **kwargs: _method(self, *args, **kwargs))
+
+def install_fakes(llm: FakeLLM):
+    """Patches the LLM and switches Celery to eager execution. Search runs on its local backend."""
+    import litellm
+    import tools
+    import worker
+    import database
+    from crewai import LLM
+
+    litellm.completion = llm.completion
+    tools.completion = llm.completion
+    LLM.call = lambda self, messages, *args, **kwargs: llm.call(messages, *args, **kwargs)
+    # Eager tasks never reach the broker, and their results stay in memory rather than in (fake) Redis
+    worker.celery_app.conf.update(
+        task_always_eager=True, task_eager_propagates=True, broker_url="memory://", result_backend="cache+memory://"
+    )
+    # The API and the worker create the indexes as they start, which the bench does not run
+    database.ensure_indexes()
+    # Build the agents up front, as each prefork process does on start
+    worker.get_pipeline_stages()
+
+def run_replica(replica: int, job_numbers: list, pages: int, settings: dict) -> dict:
+    """Runs one worker's share of the jobs through the API and returns its measurements."""
+    import resource
+    work_dir = tempfile.mkdtemp(prefix=f"bench-e2e-{replica}-")
+    os.makedirs(os.path.join(work_dir, "data"))
+    os.chdir(work_dir)
+    configure_offline_environment(work_dir)
+
+    from fastapi.testclient import TestClient
+    from bench_pdf_extraction import write_synthetic_report
+    import main
+    import database
+
+    llm = FakeLLM(settings["llm_latency"], settings["completion_tokens"])
+    install_fakes(llm)
+    client = TestClient(main.app)
+
+    latencies, stages, statuses = [], {stage: [] for stage in STAGES}, []
+    started_at = time.time()
+    for job in job_numbers:
+        report_path = os.path.join(work_dir, f"report-{job}.pdf")
+        write_synthetic_report(report_path, pages, variant=job + 1)
+        job_started = time.perf_counter()
+        with open(report_path, "rb") as f:
+            task_id = client.post(
+                "/analyze", files={"file": ("report.pdf", f, "application/pdf")}, data={"mode": settings["mode"]}
+            ).json()["task_id"]
+        statuses.append(client.get(f"/result/{task_id}").json()["status"])
+        latencies.append(time.perf_counter() - job_started)
+        task = database.get_analysis_task(task_id)
+        for stage, timing in (task.get("stages") or {}).items():
+            if "duration_seconds" in timing:
+                stages.setdefault(stage, []).append(timing["duration_seconds"])
+    finished_at = time.time()
+    os.chdir(ROOT)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "started_at": started_at,
+        "finished_at": finished_at,
+        "latencies": latencies,
+        "stages": stages,
+        "statuses": statuses,
+        "llm": llm.stats,
+        "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else float("nan")
+
+def run_level(jobs: int, concurrency: int, pages: int, settings: dict) -> dict:
+    """Spreads the jobs over `concurrency` worker processes and aggregates their measurements."""
+    shares = [list(range(jobs))[replica::concurrency] for replica in range(concurrency)]
+    # Fresh interpreters, so every process starts as a real worker would and RSS is not inherited
+    with multiprocessing.get_context("spawn").Pool(concurrency) as pool:
+        replicas = pool.starmap(run_replica, [(replica, share, pages, settings) for replica, share in enumerate(shares)])
+
+    latencies = [latency for replica in replicas for latency in replica["latencies"]]
+    statuses = [status for replica in replicas for status in replica["statuses"]]
+    wall = max(r["finished_at"] for r in replicas) - min(r["started_at"] for r in replicas)
+    return {
+        "jobs_per_second": len(latencies) / wall,
+        "failed": len(statuses) - statuses.count("COMPLETED"),
+        "latency": [percentile(latencies, fraction) for fraction in (0.5, 0.95, 0.99)],
+        "stages": {
+            stage: [percentile([d for r in replicas for d in r["stages"].get(stage, [])], f) for f in (0.5, 0.95, 0.99)]
+            for stage in STAGES
+        },
+        "llm_calls": sum(r["llm"]["calls"] for r in replicas),
+        "prompt_tokens": sum(r["llm"]["prompt_tokens"] for r in replicas),
+        "completion_tokens": sum(r["llm"]["completion_tokens"] for r in replicas),
+        "peak_rss_mb": max(r["rss_mb"] for r in replicas),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=16, help="Reports analysed at each level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4], help="Worker processes per level")
+    parser.add_argument("--pages", type=int, nargs="+", default=[2, 20], help="Page counts of the synthetic reports")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds each fake LLM call takes")
+    parser.add_argument("--completion-tokens", type=int, default=300, help="Words in each fake LLM reply")
+    parser.add_argument("--mode", default="full", help="Analysis mode sent with every report (summary, nutrition, fitness, full)")
+    args = parser.parse_args()
+    settings = {"llm_latency": args.llm_latency, "completion_tokens": args.completion_tokens, "mode": args.mode}
+    print("Redis is a private fakeredis per worker process: sharing caches, rate limits and leases between workers is not measured")
+
+    for pages in args.pages:
+        for concurrency in args.concurrency:
+            result = run_level(args.jobs, concurrency, pages, settings)
+            p50, p95, p99 = result["latency"]
+            print(f"\n{pages} page(s), {concurrency} worker(s), {args.mode} mode: {result['jobs_per_second']:.2f} jobs/s, "
+                  f"{result['failed']} failed, peak RSS {result['peak_rss_mb']:.0f} MB per worker")
+            print(f"  LLM: {result['llm_calls']} calls, {result['prompt_tokens']} prompt / "
+                  f"{result['completion_tokens']} completion tokens (estimated)")
+            print(f"  {'stage':<14} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8}")
+            print(f"  {'job':<14} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f}")
+            for stage, (s50, s95, s99) in result["stages"].items():
+                print(f"  {stage:<14} {s50:>8.2f} {s95:>8.2f} {s99:>8.2f}")
+
+if __name__ == "__main__":
+    main()
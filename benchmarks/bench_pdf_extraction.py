@@ -0,0 +1,156 @@
+# benchmarks/bench_pdf_extraction.py
+"""
+Compares the original page-by-page pdfplumber loop with the parallel, cached extraction engine.
+
+Usage:
+    [PDF_EXTRACT_WORKERS=4] python benchmarks/bench_pdf_extraction.py [--pages 50 100] [--repeat 3]
+
+Extraction is serial unless PDF_EXTRACT_WORKERS turns the process pool on.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import billiard
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdfplumber
+import pdf_extraction
+
+SAMPLE_PDF = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "sample.pdf")
+
+ROWS = [
+    ("Hemoglobin", "13.10", "g/dL", "13.00 - 17.00"),
+    ("Packed Cell Volume (PCV)", "41.00", "%", "40.00 - 50.00"),
+    ("RBC Count", "4.20", "mill/mm3", "4.50 - 5.50"),
+    ("Total Leukocyte Count (TLC)", "7.40", "thou/mm3", "4.00 - 10.00"),
+    ("Platelet Count", "210", "thou/mm3", "150.00 - 410.00"),
+    ("Cholesterol, Total", "221.00", "mg/dL", "<200.00"),
+    ("Triglycerides", "160.00", "mg/dL", "<150.00"),
+    ("Vitamin D, 25 - Hydroxy", "18.20", "nmol/L", "75.00 - 250.00"),
+    ("Glucose, Fasting", "96.00", "mg/dL", "70.00 - 100.00"),
+]
+
+def baseline_extract(file_path: str) -> str:
+    """The extraction loop BloodTestReportTool used before the extraction engine."""
+    with pdfplumber.open(file_path) as pdf:
+        text = ""
+        for page in pdf.pages:
+            page_text = page.extract_text()
+            if page_text:
+                text += page_text + "\n"
+    return text
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def write_synthetic_report(file_path: str, pages: int, lines_per_page: int = 60, variant: int = 0):
+    """
+    Writes a plain multi-page PDF of lab-style result rows, without any PDF library.
+    A non-zero `variant` shifts every value so each variant is a distinct report with distinct findings.
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # the page tree, filled in once the page object numbers are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_numbers = []
+    for page in range(pages):
+        lines = [f"Test Report - Page {page + 1} of {pages}"]
+        for i in range(lines_per_page - 1):
+            name, value, unit, interval = ROWS[(page + i) % len(ROWS)]
+            if variant:
+                value = f"{float(value) * (0.8 + (variant * 7919 % 4001) / 10000):.2f}"
+            lines.append(f"{name} {value} {unit} {interval}")
+        body = "BT /F1 9 Tf 36 806 Td 12.5 TL " + " ".join(f"({_escape(line)}) Tj T*" for line in lines) + " ET"
+        stream = body.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_number = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_number
+        )
+        page_numbers.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % number for number in page_numbers)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, pages)
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref_offset = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    with open(file_path, "wb") as f:
+        f.write(output)
+
+def _time(func, file_path: str, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(file_path)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def _daemonic_extract(file_path: str, cache_dir: str, results):
+    # Runs in a daemonic process, like a Celery prefork child running the CPU queue
+    pdf_extraction.PDF_TEXT_CACHE_DIR = cache_dir
+    start = time.perf_counter()
+    text = pdf_extraction.extract_pdf_text(file_path)
+    results.put((time.perf_counter() - start, pdf_extraction._executor is not None, text))
+
+def daemonic_extract(file_path: str, cache_dir: str):
+    """
+    Extracts a report inside a daemonic child process, as deployed workers do.
+    Returns the extraction time, whether the process pool was used, and the text.
+    """
+    results = billiard.Queue()
+    process = billiard.Process(target=_daemonic_extract, args=(file_path, cache_dir, results), daemon=True)
+    process.start()
+    result = results.get(timeout=600)
+    process.join()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[50, 100], help="Page counts of the synthetic reports")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement; the median is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        reports = [("data/sample.pdf", SAMPLE_PDF)]
+        for pages in args.pages:
+            path = os.path.join(temp_dir, f"synthetic_{pages}.pdf")
+            write_synthetic_report(path, pages)
+            reports.append((f"synthetic {pages} pages", path))
+
+        def cold_extract(file_path):
+            # A fresh cache directory per run measures parsing, not the cache
+            pdf_extraction.PDF_TEXT_CACHE_DIR = tempfile.mkdtemp(dir=temp_dir)
+            return pdf_extraction.extract_pdf_text(file_path)
+
+        print(f"Workers: {pdf_extraction.PDF_EXTRACT_WORKERS}, parallel from {pdf_extraction.PDF_PARALLEL_MIN_PAGES} pages")
+        print(f"{'report':<24}{'baseline':>12}{'engine cold':>14}{'engine cached':>16}{'speedup':>10}")
+        for label, path in reports:
+            assert cold_extract(path) == baseline_extract(path), f"Extracted text differs for {label}"
+            baseline = _time(baseline_extract, path, args.repeat)
+            cold = _time(cold_extract, path, args.repeat)
+            cached = _time(pdf_extraction.extract_pdf_text, path, args.repeat)
+            print(f"{label:<24}{baseline:>11.3f}s{cold:>13.3f}s{cached:>15.4f}s{baseline / cold:>9.1f}x")
+
+        # The path deployed workers take: the engine inside a daemonic Celery prefork child
+        label, path = reports[-1]
+        seconds, pooled, text = daemonic_extract(path, tempfile.mkdtemp(dir=temp_dir))
+        assert text == baseline_extract(path), f"Extracted text differs for {label} in a daemonic process"
+        pages = len(text.split("Test Report - Page")) - 1
+        if pages >= pdf_extraction.PDF_PARALLEL_MIN_PAGES and pdf_extraction.PDF_EXTRACT_WORKERS > 1:
+            assert pooled, "The process pool was not used inside a daemonic process"
+        print(f"{label + ' (daemonic)':<24}{'':>12}{seconds:>13.3f}s{'':>16}{'pool' if pooled else 'serial':>10}")
+
+if __name__ == "__main__":
+    main()
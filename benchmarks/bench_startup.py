@@ -0,0 +1,66 @@
+# benchmarks/bench_startup.py
+"""
+Measures the import time and peak RSS of the API and worker processes, each in a fresh interpreter.
+
+    api                   import main (enqueues by task name through celery_client)
+    api + agent stack     import main and task, i.e. what the API paid when it imported worker.py
+    worker                import worker (the pipeline is built lazily)
+    worker + pipeline     import worker and build the agents and tasks, as each pool process does at start
+
+Needs the project's dependencies and settings (e.g. MONGO_DB_NAME), but no running Mongo: importing
+database.py does not connect (MongoClient connects lazily, and the indexes are created by
+database.ensure_indexes when the API or a worker starts).
+
+Usage:
+    python benchmarks/bench_startup.py [--repeat 5]
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = {
+    "api": "import main",
+    "api + agent stack": "import main, task",
+    "worker": "import worker",
+    "worker + pipeline": "import worker; worker.get_pipeline_stages()",
+}
+
+PROBE = """
+import time, resource, json
+started = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - started
+print(json.dumps({{"seconds": elapsed, "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+"""
+
+def measure(statement: str) -> dict:
+    """Runs the statement in a new interpreter and returns its import time and peak RSS."""
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(statement=statement)],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per target; the median is reported")
+    args = parser.parse_args()
+
+    print(f"{'process':<20} {'import s':>9} {'peak RSS MB':>12}")
+    for name, statement in TARGETS.items():
+        try:
+            runs = [measure(statement) for _ in range(args.repeat)]
+        except subprocess.CalledProcessError as e:
+            print(f"{name:<20} failed: {e.stderr.strip().splitlines()[-1]}")
+            continue
+        seconds = statistics.median(run["seconds"] for run in runs)
+        rss_mb = statistics.median(run["rss_mb"] for run in runs)
+        print(f"{name:<20} {seconds:>9.2f} {rss_mb:>12.1f}")
+
+if __name__ == "__main__":
+    main()
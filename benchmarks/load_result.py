@@ -0,0 +1,91 @@
+# benchmarks/load_result.py
+"""
+Load test for GET /result/{task_id} against a running API and a local Mongo.
+
+Seeds the database configured by MONGO_URI / MONGO_DB_NAME with a mix of pending and completed
+tasks (completed ones carry a large markdown result), then fires requests at each concurrency
+level and reports throughput and p50/p95/p99 latency. Seeded tasks are removed afterwards.
+
+Usage:
+    uvicorn main:app --workers 1 &
+    python benchmarks/load_result.py [--url http://localhost:8000] [--concurrency 10 50 200] [--requests 2000]
+"""
+import os
+import sys
+import time
+import uuid
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from database import analysis_collection, new_task_document, create_analysis_tasks
+
+def seed_tasks(count: int, result_bytes: int) -> list:
+    """Inserts `count` tasks, every other one COMPLETED with a result of `result_bytes` characters."""
+    run_id = uuid.uuid4().hex[:8]
+    documents = []
+    for i in range(count):
+        document = new_task_document(f"loadtest-{run_id}-{i}", "loadtest.pdf", "Summarise my Blood Test Report")
+        if i % 2:
+            document["status"] = "COMPLETED"
+            document["result"] = "## Medical Analysis Summary\n" + "x" * result_bytes
+        documents.append(document)
+    create_analysis_tasks(documents)
+    return [document["_id"] for document in documents]
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def run_level(url: str, task_ids: list, concurrency: int, total_requests: int) -> dict:
+    """Sends `total_requests` requests from `concurrency` concurrent clients and collects latencies."""
+    latencies, errors = [], 0
+    counter = iter(range(total_requests))
+
+    async def client_loop(client):
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            response = await client.get(f"{url}/result/{task_ids[i % len(task_ids)]}")
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "throughput": total_requests / elapsed,
+        "p50": statistics.median(latencies) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "errors": errors,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000", help="Base URL of the running API")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 200], help="Concurrent clients per level")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests sent at each concurrency level")
+    parser.add_argument("--tasks", type=int, default=1000, help="Number of tasks to seed")
+    parser.add_argument("--result-bytes", type=int, default=20000, help="Size of each completed task's result")
+    args = parser.parse_args()
+
+    task_ids = seed_tasks(args.tasks, args.result_bytes)
+    try:
+        print(f"{'clients':>8} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for concurrency in args.concurrency:
+            stats = asyncio.run(run_level(args.url, task_ids, concurrency, args.requests))
+            print(f"{concurrency:>8} {stats['throughput']:>9.1f} {stats['p50']:>8.1f} {stats['p95']:>8.1f} "
+                  f"{stats['p99']:>8.1f} {stats['errors']:>7}")
+    finally:
+        analysis_collection.delete_many({"_id": {"$in": task_ids}})
+
+if __name__ == "__main__":
+    main()
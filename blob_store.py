@@ -0,0 +1,188 @@
+# blob_store.py
+import os
+import shutil
+import logging
+import threading
+from abc import ABC, abstractmethod
+from dotenv import load_dotenv
+from database import db, acquire_blob, release_blob, claim_unreferenced_blobs, forget_blob
+from metrics import registry
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# "local" keeps blobs in BLOB_DIR, which must be a volume shared by the API and every worker;
+# "gridfs" keeps them in the Mongo database, and workers copy what they read into BLOB_CACHE_DIR
+BLOB_STORE = os.getenv("BLOB_STORE", "local")
+BLOB_DIR = os.getenv("BLOB_DIR", "data/blobs")
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR", "data/.blob_cache")
+BLOB_CACHE_MAX_FILES = int(os.getenv("BLOB_CACHE_MAX_FILES", 200))
+# A blob no job references is kept this long, so a re-upload of the same report finds it in place
+BLOB_GC_GRACE_SECONDS = int(os.getenv("BLOB_GC_GRACE_SECONDS", 3600))
+
+def _move_file(source_path: str, target_path: str):
+    """Moves a file into place atomically, copying it first when the two are on different filesystems."""
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    try:
+        os.replace(source_path, target_path)
+    except OSError:
+        temp_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, target_path)
+        os.remove(source_path)
+
+class BlobStore(ABC):
+    """
+    Content-addressed storage for uploaded reports: every blob is stored once, under the SHA-256 of its
+    content, however many jobs use it. Which blobs are still referenced is tracked in Mongo (see database.py).
+    """
+
+    @abstractmethod
+    def exists(self, file_hash: str) -> bool:
+        ...
+
+    @abstractmethod
+    def put(self, file_hash: str, source_path: str) -> bool:
+        """Moves a file into the store. Returns False when the blob was already stored (the file is then removed)."""
+
+    @abstractmethod
+    def local_path(self, file_hash: str) -> str:
+        """Returns the path of a local copy of the blob, for memory-mapped reads."""
+
+    @abstractmethod
+    def delete(self, file_hash: str):
+        ...
+
+class LocalBlobStore(BlobStore):
+    """Blobs as files under a directory, fanned out by the first characters of their hash."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, file_hash: str) -> str:
+        return os.path.join(self.directory, file_hash[:2], file_hash[2:4], f"{file_hash}.pdf")
+
+    def exists(self, file_hash: str) -> bool:
+        return os.path.exists(self._path(file_hash))
+
+    def put(self, file_hash: str, source_path: str) -> bool:
+        if self.exists(file_hash):
+            os.remove(source_path)
+            return False
+        _move_file(source_path, self._path(file_hash))
+        return True
+
+    def local_path(self, file_hash: str) -> str:
+        path = self._path(file_hash)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Blob {file_hash} is not in the store.")
+        return path
+
+    def delete(self, file_hash: str):
+        try:
+            os.remove(self._path(file_hash))
+        except FileNotFoundError:
+            pass
+
+class GridFSBlobStore(BlobStore):
+    """
+    Blobs in GridFS, named by their hash, so every worker can fetch them without a shared volume.
+    A worker downloads a blob once into its local cache directory and reads it from there.
+    """
+
+    def __init__(self, database, cache_directory: str, max_cached_files: int):
+        import gridfs
+        self.bucket = gridfs.GridFSBucket(database, bucket_name="blobs")
+        self.files = database["blobs.files"]
+        self.cache_directory = cache_directory
+        self.max_cached_files = max_cached_files
+
+    def exists(self, file_hash: str) -> bool:
+        # The files document is written after the last chunk, so a listed blob is complete
+        return self.files.find_one({"filename": file_hash}, {"_id": 1}) is not None
+
+    def put(self, file_hash: str, source_path: str) -> bool:
+        if self.exists(file_hash):
+            os.remove(source_path)
+            return False
+        # Two uploads racing on the same blob store two identical revisions; reads take the latest
+        with open(source_path, "rb") as f:
+            self.bucket.upload_from_stream(file_hash, f)
+        os.remove(source_path)
+        return True
+
+    def local_path(self, file_hash: str) -> str:
+        path = os.path.join(self.cache_directory, f"{file_hash}.pdf")
+        if os.path.exists(path):
+            os.utime(path)
+            return path
+        os.makedirs(self.cache_directory, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            self.bucket.download_to_stream_by_name(file_hash, f)
+        os.replace(temp_path, path)
+        self._prune_cache()
+        return path
+
+    def _prune_cache(self):
+        """Drops the least recently read copies once the cache holds more than max_cached_files."""
+        entries = [entry for entry in os.scandir(self.cache_directory) if entry.name.endswith(".pdf")]
+        if len(entries) > self.max_cached_files:
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:len(entries) - self.max_cached_files]:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def delete(self, file_hash: str):
+        for revision in self.files.find({"filename": file_hash}, {"_id": 1}):
+            self.bucket.delete(revision["_id"])
+        try:
+            os.remove(os.path.join(self.cache_directory, f"{file_hash}.pdf"))
+        except FileNotFoundError:
+            pass
+
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+def get_blob_store() -> BlobStore:
+    """Returns the store configured by BLOB_STORE, created on first use."""
+    global _blob_store
+    with _blob_store_lock:
+        if _blob_store is None:
+            if BLOB_STORE == "gridfs":
+                _blob_store = GridFSBlobStore(db, BLOB_CACHE_DIR, BLOB_CACHE_MAX_FILES)
+            elif BLOB_STORE == "local":
+                _blob_store = LocalBlobStore(BLOB_DIR)
+            else:
+                raise ValueError(f"Unknown BLOB_STORE '{BLOB_STORE}', expected 'local' or 'gridfs'.")
+    return _blob_store
+
+def store_report(task_id: str, file_hash: str, source_path: str):
+    """
+    Takes a reference on a report's blob for a queued job and moves the uploaded file into the store,
+    unless an identical report is already there. The reference is dropped by release_report.
+    """
+    # Referenced before it is stored, so the garbage collector never deletes a blob that is being reused
+    acquire_blob(task_id, file_hash, os.path.getsize(source_path))
+    stored = get_blob_store().put(file_hash, source_path)
+    registry.inc("blob_writes_total", outcome="stored" if stored else "deduplicated")
+
+def release_report(task_id: str, file_hash: str):
+    """Drops the job's reference on its report's blob, if it took one. Safe to call again for a redelivered job."""
+    release_blob(task_id, file_hash)
+
+def collect_garbage() -> int:
+    """Deletes the blobs no job has referenced for BLOB_GC_GRACE_SECONDS. Returns how many were deleted."""
+    store = get_blob_store()
+    deleted = 0
+    for file_hash in claim_unreferenced_blobs(BLOB_GC_GRACE_SECONDS):
+        store.delete(file_hash)
+        forget_blob(file_hash)
+        deleted += 1
+    if deleted:
+        registry.inc("blobs_collected_total", deleted)
+        logger.info(f"Garbage-collected {deleted} unreferenced blob(s).")
+    return deleted
@@ -0,0 +1,288 @@
+# cache.py
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import redis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Directory for shared cache tiers when Redis is not available
+CACHE_DIR = os.getenv("CACHE_DIR", "data/.cache")
+
+# Bump this whenever agents.py or task.py change in a way that alters the final report,
+# so results produced by an older agent/task configuration are never served from the cache.
+ANALYSIS_CONFIG_VERSION = os.getenv("ANALYSIS_CONFIG_VERSION", "4")
+
+def normalize_query(query: str) -> str:
+    """Collapses whitespace and case so trivially different queries share a cache entry."""
+    return re.sub(r"\s+", " ", query or "").strip().lower()
+
+def result_cache_key(file_hash: str, query: str, mode: str = "full", patient_id: str = None) -> str:
+    """
+    Builds the result cache key from the PDF content hash, the normalized query, the analysis mode,
+    the patient and the config version. Each mode runs different stages, and each patient's analysis
+    reflects their own history, so each is cached separately.
+    """
+    payload = "\x00".join([ANALYSIS_CONFIG_VERSION, file_hash, normalize_query(query), mode, patient_id or ""])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def make_cache_key(payload) -> str:
+    """Hashes a JSON-serializable payload in canonical form (sorted keys, no insignificant whitespace)."""
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class LRUCache:
+    """Thread-safe in-process cache with least-recently-used eviction and a per-entry TTL."""
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class RedisCache:
+    """Shared cache tier in Redis. A sorted set of write times caps the number of entries."""
+
+    def __init__(self, client, namespace: str, max_entries: int, ttl_seconds: int):
+        self.client = client
+        self.prefix = f"cache:{namespace}:"
+        self.index_key = f"cache:{namespace}:__index__"
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, key: str):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value):
+        pipe = self.client.pipeline()
+        pipe.setex(self.prefix + key, self.ttl_seconds, json.dumps(value))
+        pipe.zadd(self.index_key, {key: time.time()})
+        pipe.zcard(self.index_key)
+        excess = pipe.execute()[-1] - self.max_entries
+        if excess > 0:
+            oldest = self.client.zrange(self.index_key, 0, excess - 1)
+            pipe = self.client.pipeline()
+            pipe.delete(*[self.prefix + old.decode() for old in oldest])
+            pipe.zrem(self.index_key, *oldest)
+            pipe.execute()
+
+class DiskCache:
+    """Shared cache tier on the local disk, for hosts without Redis. One JSON file per entry."""
+
+    def __init__(self, directory: str, max_entries: int, ttl_seconds: int):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key: str):
+        path = os.path.join(self.directory, f"{key}.json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry["expires_at"] <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry["value"]
+
+    def set(self, key: str, value):
+        path = os.path.join(self.directory, f"{key}.json")
+        # Write to a temporary file first so concurrent readers never see a partial entry
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"expires_at": time.time() + self.ttl_seconds, "value": value}, f)
+        os.replace(temp_path, path)
+
+        # Drop the expired entries, then the oldest ones beyond max_entries
+        entries = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        expired_before = time.time() - self.ttl_seconds
+        expired = sum(1 for entry in entries if entry.stat().st_mtime <= expired_before)
+        for entry in entries[:max(expired, len(entries) - self.max_entries)]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+def get_redis_client(purpose: str, socket_timeout: float = 2):
+    """Returns a connected Redis client for REDIS_URL, or None (with a warning) when Redis is unreachable."""
+    redis_url = os.getenv("REDIS_URL")
+    if not redis_url:
+        return None
+    try:
+        client = redis.Redis.from_url(redis_url, socket_timeout=socket_timeout, socket_connect_timeout=2)
+        client.ping()
+        return client
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for {purpose}, using a local fallback: {e}")
+        return None
+
+def _shared_tier(namespace: str, max_entries: int, ttl_seconds: int):
+    """Returns the Redis tier when REDIS_URL is reachable, otherwise an on-disk tier under CACHE_DIR."""
+    client = get_redis_client(f"the '{namespace}' cache")
+    if client is not None:
+        return RedisCache(client, namespace, max_entries, ttl_seconds)
+    return DiskCache(os.path.join(CACHE_DIR, namespace), max_entries, ttl_seconds)
+
+class TieredCache:
+    """
+    Two-tier cache: an in-process LRU in front of a tier shared by every worker (Redis, or disk without it).
+    Values must be JSON-serializable. `stats` counts hits per tier and misses.
+    """
+
+    def __init__(self, namespace: str, max_entries: int, shared_max_entries: int, ttl_seconds: int):
+        self.namespace = namespace
+        self.local = LRUCache(max_entries, ttl_seconds)
+        self.shared = _shared_tier(namespace, shared_max_entries, ttl_seconds)
+        self.stats = {"local_hits": 0, "shared_hits": 0, "misses": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, stat: str):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def get(self, key: str):
+        value = self.local.get(key)
+        if value is not None:
+            self._count("local_hits")
+            return value
+        try:
+            value = self.shared.get(key)
+        except Exception as e:
+            # A broken shared tier degrades to a miss instead of failing the caller
+            logger.warning(f"Shared '{self.namespace}' cache read failed: {e}")
+            value = None
+        if value is None:
+            self._count("misses")
+            return None
+        self._count("shared_hits")
+        self.local.set(key, value)
+        return value
+
+    def set(self, key: str, value):
+        self.local.set(key, value)
+        try:
+            self.shared.set(key, value)
+        except Exception as e:
+            logger.warning(f"Shared '{self.namespace}' cache write failed: {e}")
+
+# Deletes a single-flight lease only if it still belongs to the caller
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class SingleFlight:
+    """
+    Collapses concurrent lookups of the same key into a single computation in front of a TieredCache.
+    Within a process, callers of one key queue on a shared lock. Across workers, one caller holds a short
+    Redis lease while it computes and the others wait for the value to appear in the cache.
+    """
+
+    def __init__(self, cache: TieredCache, lease_seconds: int = 30):
+        self.cache = cache
+        self.lease_seconds = lease_seconds
+        self.prefix = f"singleflight:{cache.namespace}:"
+        self.client = get_redis_client(f"the '{cache.namespace}' single-flight leases")
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _local_lock(self, key: str):
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    def _wait_for_leader(self, key: str, token: str):
+        """Takes the lease for `key`, or waits for its holder's value. Returns (value, holds_lease)."""
+        lease_key = self.prefix + key
+        deadline = time.time() + self.lease_seconds
+        while time.time() < deadline:
+            if self.client.set(lease_key, token, nx=True, ex=self.lease_seconds):
+                return None, True
+            time.sleep(0.1)
+            value = self.cache.get(key)
+            if value is not None:
+                return value, False
+        return None, False
+
+    def do(self, key: str, compute):
+        """
+        Returns (value, computed): the cached value for `key`, or the result of compute(), which is cached.
+        `computed` is False when the value came from the cache or from a concurrent identical lookup.
+        Exceptions from compute() propagate and nothing is cached.
+        """
+        value = self.cache.get(key)
+        if value is not None:
+            return value, False
+        with self._local_lock(key):
+            # Another thread of this process may have computed it while we queued
+            value = self.cache.get(key)
+            if value is not None:
+                return value, False
+
+            token, holds_lease = uuid.uuid4().hex, False
+            if self.client is not None:
+                try:
+                    value, holds_lease = self._wait_for_leader(key, token)
+                    if value is not None:
+                        return value, False
+                except redis.RedisError as e:
+                    logger.warning(f"Single-flight lease for '{self.cache.namespace}' unavailable: {e}")
+            try:
+                value = compute()
+                self.cache.set(key, value)
+                return value, True
+            finally:
+                if holds_lease:
+                    try:
+                        self.client.eval(RELEASE_LEASE_SCRIPT, 1, self.prefix + key, token)
+                    except redis.RedisError as e:
+                        logger.warning(f"Could not release single-flight lease (it will expire): {e}")
@@ -0,0 +1,60 @@
+# celery_client.py
+import os
+from celery import Celery
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Registered task names. The API enqueues jobs by name, so it never imports the worker or the agent stack.
+PROCESS_REPORT_TASK = "process_report_task"
+RUN_STAGE_TASK = "run_stage_task"
+FINISH_REPORT_TASK = "finish_report_task"
+COLLECT_BLOBS_TASK = "collect_blobs_task"
+
+# CPU-bound work (PDF parsing) and I/O-bound work (LLM stages) go to separate queues, so each can be
+# served by the right pool: prefork processes for the CPU queue, a large thread pool for the I/O queue.
+CPU_QUEUE = os.getenv("CELERY_CPU_QUEUE", "reports.cpu")
+IO_QUEUE = os.getenv("CELERY_IO_QUEUE", "reports.io")
+# Priority lanes: bulk uploads get their own pair of queues, so a large batch never sits in front of
+# interactive single-report jobs. Workers consuming both take from each in turn.
+CPU_BULK_QUEUE = os.getenv("CELERY_CPU_BULK_QUEUE", f"{CPU_QUEUE}.bulk")
+IO_BULK_QUEUE = os.getenv("CELERY_IO_BULK_QUEUE", f"{IO_QUEUE}.bulk")
+LANES = {
+    "interactive": {"cpu": CPU_QUEUE, "io": IO_QUEUE},
+    "bulk": {"cpu": CPU_BULK_QUEUE, "io": IO_BULK_QUEUE},
+}
+# How often `celery beat` has a worker garbage-collect the report blobs no job references any more
+BLOB_GC_INTERVAL_SECONDS = int(os.getenv("BLOB_GC_INTERVAL_SECONDS", 600))
+
+# Initialize Celery
+celery_app = Celery(
+    'tasks',
+    broker=os.getenv("REDIS_URL"),
+    backend=os.getenv("REDIS_URL")
+)
+
+celery_app.conf.update(
+    task_track_started=True,
+    broker_connection_retry_on_startup=True,
+    task_routes={
+        PROCESS_REPORT_TASK: {"queue": CPU_QUEUE},
+        RUN_STAGE_TASK: {"queue": IO_QUEUE},
+        FINISH_REPORT_TASK: {"queue": IO_QUEUE},
+        COLLECT_BLOBS_TASK: {"queue": CPU_QUEUE},
+    },
+    beat_schedule={
+        "collect-blobs": {"task": COLLECT_BLOBS_TASK, "schedule": BLOB_GC_INTERVAL_SECONDS},
+    },
+    # Redeliver a step whose worker died mid-way; checkpoints make re-running it cheap
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    # A worker holds only the message it is running, so long LLM stages do not hide queued work
+    worker_prefetch_multiplier=1
+)
+
+def process_report_signature(task_id: str, file_hash: str, query: str, cache_key: str = None, lane: str = "interactive"):
+    """
+    Builds a call to the worker's process_report_task, ready to be applied or grouped, on the CPU queue of its lane.
+    The report is passed by the hash of its blob in the shared blob store, not by a local path.
+    """
+    return celery_app.signature(PROCESS_REPORT_TASK, args=(task_id, file_hash, query, cache_key), queue=LANES[lane]["cpu"])
@@ -1,36 +1,177 @@
 # database.py
 import os
-from pymongo import MongoClient
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, ReturnDocument, UpdateOne, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 
 load_dotenv()
 
 MONGO_URI = os.getenv("MONGO_URI")
 MONGO_DB_NAME = os.getenv("MONGO_DB_NAME")
 
-client = MongoClient(MONGO_URI)
+# Connection pool settings. The API also runs at most MONGO_MAX_POOL_SIZE queries at once (see run_db),
+# so requests queue in the event loop instead of piling up on the pool's wait queue.
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 50))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 5))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 60000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+
+# Tasks and batches are removed by Mongo this long after they were created
+ANALYSIS_TASK_TTL_SECONDS = int(os.getenv("ANALYSIS_TASK_TTL_SECONDS", 30 * 24 * 3600))
+
+# Result cache settings
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+# The cache is trimmed by entry count, whatever the size of the results (each entry records its `size`)
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 10000))
+# How long a job may run. Its in-flight claim lasts this long past the longest the job may still wait in its
+# lane's queues, and is extended whenever the job makes progress; a claim that expires is treated as
+# abandoned (e.g. the worker died) and the next identical request runs the job again
+RESULT_CACHE_INFLIGHT_TIMEOUT_SECONDS = int(os.getenv("RESULT_CACHE_INFLIGHT_TIMEOUT_SECONDS", 30 * 60))
+
+client = MongoClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    retryWrites=True
+)
 db = client[MONGO_DB_NAME]
 analysis_collection = db["analysis_tasks"]
+result_cache_collection = db["result_cache"]
+batch_collection = db["analysis_batches"]
+# Reference counts of the content-addressed report blobs (see blob_store.py)
+blob_collection = db["blobs"]
+# Every analyte value of each patient's completed reports, one small document per value (see trends.py)
+analyte_history_collection = db["analyte_history"]
 
-def create_analysis_task(task_id: str, file_name: str, query: str):
-    """Inserts a new task record into the database."""
-    task_document = {
+def _ensure_ttl_index(collection, field: str, expire_after_seconds: int):
+    """Creates a TTL index, or updates its expiry in place when the configured TTL has changed."""
+    try:
+        collection.create_index(field, expireAfterSeconds=expire_after_seconds)
+    except OperationFailure as e:
+        if e.code != 85:  # IndexOptionsConflict
+            raise
+        db.command("collMod", collection.name, index={"keyPattern": {field: 1}, "expireAfterSeconds": expire_after_seconds})
+
+def ensure_indexes():
+    """
+    Creates the indexes (and TTLs) of every collection, updating TTLs whose configuration has changed.
+    Idempotent; run when the API starts and when a Celery worker starts, not at import, so importing
+    this module never needs a reachable Mongo.
+    """
+    analysis_collection.create_index("cache_key", sparse=True)
+    analysis_collection.create_index("batch_id", sparse=True)
+    analysis_collection.create_index([("status", ASCENDING), ("created_at", DESCENDING)])
+    _ensure_ttl_index(analysis_collection, "created_at", ANALYSIS_TASK_TTL_SECONDS)
+    _ensure_ttl_index(batch_collection, "created_at", ANALYSIS_TASK_TTL_SECONDS)
+    # Mongo removes cache entries (and abandoned in-flight claims) once expires_at has passed
+    result_cache_collection.create_index("expires_at", expireAfterSeconds=0)
+    result_cache_collection.create_index("last_accessed_at")
+    blob_collection.create_index([("refs", ASCENDING), ("updated_at", ASCENDING)])
+    analyte_history_collection.create_index([("patient_id", ASCENDING), ("analyte", ASCENDING), ("taken_at", ASCENDING)])
+    # A report uploaded again for the same patient adds no new readings
+    analyte_history_collection.create_index(
+        [("patient_id", ASCENDING), ("file_hash", ASCENDING), ("analyte", ASCENDING), ("unit", ASCENDING)], unique=True
+    )
+
+# Dedicated threads for the API's queries, one per pooled connection
+_db_executor = ThreadPoolExecutor(max_workers=MONGO_MAX_POOL_SIZE, thread_name_prefix="mongo")
+
+async def run_db(func, *args, **kwargs):
+    """
+    Runs one of the functions below from async code without blocking the event loop.
+    Queries go to a thread pool sized to the connection pool rather than the shared default one.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+def new_task_document(task_id: str, file_name: str, query: str, cache_key: str = None, batch_id: str = None,
+                      mode: str = "full", lane: str = "interactive", patient_id: str = None):
+    """
+    Builds a PENDING task record. `mode` is the analysis mode, which decides the stages the job runs,
+    and `lane` the priority lane (interactive or bulk) whose queues it runs on. The values of a task
+    with a `patient_id` are added to that patient's analyte history once it completes.
+    """
+    return {
         "_id": task_id,
         "file_name": file_name,
         "query": query,
+        "mode": mode,
+        "lane": lane,
+        "patient_id": patient_id,
         "status": "PENDING",
         "result": None,
+        "cache_key": cache_key,
+        "batch_id": batch_id,
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
     }
+
+def create_analysis_task(task_id: str, file_name: str, query: str, cache_key: str = None):
+    """Inserts a new task record into the database."""
+    task_document = new_task_document(task_id, file_name, query, cache_key)
     analysis_collection.insert_one(task_document)
     return task_document
 
+def create_analysis_tasks(task_documents: list):
+    """Inserts many task records (see new_task_document) in a single round-trip."""
+    analysis_collection.insert_many(task_documents, ordered=False)
+    return task_documents
+
 def get_analysis_task(task_id: str):
     """Retrieves a task record from the database."""
     return analysis_collection.find_one({"_id": task_id})
 
+def get_analysis_task_status(task_id: str):
+    """Retrieves a task's status and stage timings, leaving out the (potentially large) result."""
+    return analysis_collection.find_one({"_id": task_id}, {"status": 1, "stages": 1, "created_at": 1, "updated_at": 1})
+
+def get_analysis_task_result(task_id: str):
+    """Retrieves what /result reports: the status, timestamps and result, without the stages or inputs."""
+    return analysis_collection.find_one({"_id": task_id}, {"status": 1, "result": 1, "created_at": 1, "updated_at": 1})
+
+def start_analysis_task(task_id: str):
+    """Marks a task PROCESSING, keeping the time its first attempt started. Settled tasks are left alone."""
+    now = datetime.utcnow()
+    analysis_collection.update_one(
+        {"_id": task_id, "status": {"$nin": ["COMPLETED", "FAILED"]}},
+        {"$set": {"status": "PROCESSING", "updated_at": now}, "$min": {"started_at": now}}
+    )
+
+def get_task_checkpoint(task_id: str):
+    """Retrieves what a worker needs to run or resume a stage: the status, inputs and checkpointed outputs."""
+    return analysis_collection.find_one(
+        {"_id": task_id}, {
+            "status": 1, "query": 1, "mode": 1, "lane": 1, "patient_id": 1, "cache_key": 1,
+            "created_at": 1, "started_at": 1, "checkpoint": 1
+        }
+    )
+
+def save_checkpoint(task_id: str, key: str, value):
+    """Checkpoints a finished step (the parsed findings, or a stage's output) so a retry does not redo it."""
+    analysis_collection.update_one(
+        {"_id": task_id}, {"$set": {f"checkpoint.{key}": value, "updated_at": datetime.utcnow()}}
+    )
+
+def claim_checkpoint(task_id: str, key: str, value) -> bool:
+    """
+    Checkpoints a step only if no attempt has yet, for steps that must not run twice (e.g. queueing a job's
+    stages). Returns True if this caller claimed the step and should run it.
+    """
+    claimed = analysis_collection.update_one(
+        {"_id": task_id, f"checkpoint.{key}": None},
+        {"$set": {f"checkpoint.{key}": value, "updated_at": datetime.utcnow()}}
+    )
+    return claimed.modified_count == 1
+
 def update_analysis_task(task_id: str, status: str, result: str = None):
     """Updates the status and result of a task."""
     update_data = {
@@ -41,5 +182,246 @@ def update_analysis_task(task_id: str, status: str, result: str = None):
     }
     if result is not None:
         update_data["$set"]["result"] = result
-        
-    analysis_collection.update_one({"_id": task_id}, update_data)
\ No newline at end of file
+
+    analysis_collection.update_one({"_id": task_id}, update_data)
+
+def complete_analysis_tasks(results: dict):
+    """Marks many tasks COMPLETED in one bulk write. `results` maps task_id to its result."""
+    now = datetime.utcnow()
+    analysis_collection.bulk_write([
+        UpdateOne({"_id": task_id}, {"$set": {"status": "COMPLETED", "result": result, "updated_at": now}})
+        for task_id, result in results.items()
+    ], ordered=False)
+
+def fail_pending_tasks(task_ids: list, error: str):
+    """Marks the tasks among `task_ids` that are still PENDING as FAILED with `error`, in one update."""
+    analysis_collection.update_many(
+        {"_id": {"$in": task_ids}, "status": "PENDING"},
+        {"$set": {"status": "FAILED", "result": error, "updated_at": datetime.utcnow()}}
+    )
+
+def create_analysis_batch(batch_id: str, task_ids: list, query: str, rejected: list):
+    """Inserts a batch record listing its tasks and the uploads that were rejected."""
+    batch_document = {
+        "_id": batch_id,
+        "task_ids": task_ids,
+        "query": query,
+        "rejected": rejected,
+        "created_at": datetime.utcnow()
+    }
+    batch_collection.insert_one(batch_document)
+    return batch_document
+
+def get_analysis_batch(batch_id: str):
+    """Retrieves a batch record from the database."""
+    return batch_collection.find_one({"_id": batch_id})
+
+def get_batch_tasks(batch_id: str, include_results: bool = True):
+    """Retrieves every task of a batch in one query, leaving out the results unless asked for."""
+    projection = {"file_name": 1, "status": 1, "created_at": 1, "updated_at": 1}
+    if include_results:
+        projection["result"] = 1
+    return list(analysis_collection.find({"batch_id": batch_id}, projection).sort("created_at", 1))
+
+def claim_cached_result(cache_key: str, task_id: str, wait_seconds: float = 0):
+    """
+    Looks up the result cache for a key, claiming it for `task_id` on a miss. The claim lasts `wait_seconds`,
+    the longest the job may wait to start, plus RESULT_CACHE_INFLIGHT_TIMEOUT_SECONDS.
+    Returns None when the caller now owns the job and must enqueue it. Otherwise returns
+    the existing cache entry: status "READY" with a result, or "IN_FLIGHT" with the owning task_id.
+    """
+    now = datetime.utcnow()
+    entry = result_cache_collection.find_one_and_update(
+        {"_id": cache_key, "status": "READY", "expires_at": {"$gt": now}},
+        {"$set": {"last_accessed_at": now}, "$inc": {"hits": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if entry:
+        return entry
+
+    try:
+        # Only matches (and replaces) an expired entry; a live entry makes the upsert collide on _id.
+        result_cache_collection.update_one(
+            {"_id": cache_key, "expires_at": {"$lte": now}},
+            {"$set": {
+                "status": "IN_FLIGHT",
+                "task_id": task_id,
+                "result": None,
+                "size": 0,
+                "hits": 0,
+                "created_at": now,
+                "last_accessed_at": now,
+                "expires_at": now + timedelta(seconds=wait_seconds + RESULT_CACHE_INFLIGHT_TIMEOUT_SECONDS)
+            }},
+            upsert=True
+        )
+        return None
+    except DuplicateKeyError:
+        entry = result_cache_collection.find_one({"_id": cache_key})
+        # The entry may have vanished between the upsert and this read; retry the claim once.
+        return entry if entry else claim_cached_result(cache_key, task_id, wait_seconds)
+
+def extend_cache_claim(cache_key: str, task_id: str, wait_seconds: float = 0):
+    """
+    Renews the in-flight claim `task_id` holds on `cache_key` as its job makes progress, so a long-running job
+    is not taken for abandoned. A claim that has already passed to another job is left alone.
+    """
+    result_cache_collection.update_one(
+        {"_id": cache_key, "task_id": task_id, "status": "IN_FLIGHT"},
+        {"$set": {"expires_at": datetime.utcnow() + timedelta(seconds=wait_seconds + RESULT_CACHE_INFLIGHT_TIMEOUT_SECONDS)}}
+    )
+
+def resolve_cached_result(cache_key: str, task_id: str, status: str, result: str):
+    """
+    Publishes the outcome of the job that owns `cache_key` and settles every task coalesced onto it.
+    Completed results are cached; failures release the claim so the next request retries.
+    Returns the IDs of the coalesced tasks that were settled.
+    """
+    now = datetime.utcnow()
+    if status == "COMPLETED":
+        result_cache_collection.update_one(
+            {"_id": cache_key, "task_id": task_id},
+            {"$set": {
+                "status": "READY",
+                "result": result,
+                "size": len(result),
+                "last_accessed_at": now,
+                "expires_at": now + timedelta(seconds=RESULT_CACHE_TTL_SECONDS)
+            }}
+        )
+        _evict_result_cache()
+    else:
+        result_cache_collection.delete_one({"_id": cache_key, "task_id": task_id})
+
+    followers = {"cache_key": cache_key, "status": "PENDING", "_id": {"$ne": task_id}}
+    follower_ids = [task["_id"] for task in analysis_collection.find(followers, {"_id": 1})]
+    analysis_collection.update_many(followers, {"$set": {"status": status, "result": result, "updated_at": now}})
+    return follower_ids
+
+def _evict_result_cache():
+    """Drops the least recently used READY entries once there are more than RESULT_CACHE_MAX_ENTRIES of them."""
+    excess = result_cache_collection.count_documents({"status": "READY"}) - RESULT_CACHE_MAX_ENTRIES
+    if excess <= 0:
+        return
+    stale = result_cache_collection.find(
+        {"status": "READY"}, {"_id": 1}
+    ).sort("last_accessed_at", 1).limit(excess)
+    result_cache_collection.delete_many({"_id": {"$in": [entry["_id"] for entry in stale]}})
+
+def save_task_metrics(task_id: str, metrics: dict):
+    """
+    Adds what one step of a job spent (LLM calls, tokens, retries, cache hits, time per stage)
+    to the job's totals on its task record. A job's stages may run on different workers.
+    """
+    increments = {f"metrics.{name}": amount for name, amount in metrics.items() if name != "stages"}
+    for stage, counters in metrics.get("stages", {}).items():
+        increments.update({f"metrics.stages.{stage}.{name}": amount for name, amount in counters.items()})
+    analysis_collection.update_one({"_id": task_id}, {"$inc": increments})
+
+def count_tasks_by_status() -> dict:
+    """Counts the stored tasks in each status."""
+    return {group["_id"]: group["count"] for group in analysis_collection.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ])}
+
+def update_stage_timing(task_id: str, stage: str, started_at: datetime, finished_at: datetime = None):
+    """Records when a pipeline stage started and, once known, when it finished."""
+    update_data = {f"stages.{stage}.started_at": started_at, "updated_at": datetime.utcnow()}
+    if finished_at is not None:
+        update_data[f"stages.{stage}.finished_at"] = finished_at
+        update_data[f"stages.{stage}.duration_seconds"] = (finished_at - started_at).total_seconds()
+    analysis_collection.update_one({"_id": task_id}, {"$set": update_data})
+
+def acquire_blob(task_id: str, file_hash: str, size: int):
+    """
+    Adds a task's reference to a report blob, registering the blob on its first reference, and records
+    on the task that it holds one, so release_blob only ever drops a reference that was taken.
+    A blob the garbage collector is deleting makes the upsert collide on _id; it is retried
+    until the deletion is finished, and the blob is then registered (and stored) afresh.
+    """
+    for _ in range(50):
+        now = datetime.utcnow()
+        try:
+            blob_collection.update_one(
+                {"_id": file_hash, "state": "live"},
+                {"$inc": {"refs": 1}, "$set": {"updated_at": now}, "$setOnInsert": {"size": size, "created_at": now}},
+                upsert=True
+            )
+            # Recorded after the increment: a crash in between leaks a reference rather than dropping another's
+            analysis_collection.update_one({"_id": task_id}, {"$set": {"blob_acquired_at": now}})
+            return
+        except DuplicateKeyError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Blob {file_hash} is still being deleted.")
+
+def release_blob(task_id: str, file_hash: str):
+    """
+    Drops a task's reference to its report blob, once, and only if acquire_blob took one: the task record
+    remembers both.
+    """
+    now = datetime.utcnow()
+    released = analysis_collection.update_one(
+        {"_id": task_id, "blob_acquired_at": {"$ne": None}, "blob_released_at": None},
+        {"$set": {"blob_released_at": now}}
+    )
+    if released.modified_count:
+        blob_collection.update_one({"_id": file_hash}, {"$inc": {"refs": -1}, "$set": {"updated_at": now}})
+
+def claim_unreferenced_blobs(grace_seconds: int) -> list:
+    """
+    Marks the blobs that have had no reference for grace_seconds as being deleted and returns their hashes.
+    A claim left behind by a collector that died is claimed again once the grace period has passed.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    unreferenced = {"refs": {"$lte": 0}, "updated_at": {"$lt": cutoff}}
+    claimed = []
+    for blob in blob_collection.find(unreferenced, {"_id": 1}):
+        marked = blob_collection.update_one(
+            {"_id": blob["_id"], **unreferenced}, {"$set": {"state": "deleting", "updated_at": datetime.utcnow()}}
+        )
+        if marked.modified_count:
+            claimed.append(blob["_id"])
+    return claimed
+
+def forget_blob(file_hash: str):
+    """Removes a deleted blob's record, letting the next upload of the same report store it again."""
+    blob_collection.delete_one({"_id": file_hash, "state": "deleting"})
+
+def record_analyte_history(patient_id: str, task_id: str, file_hash: str, taken_at: datetime, values: list):
+    """Adds the analyte values of a completed report to the patient's history in one bulk write."""
+    if not values:
+        return
+    now = datetime.utcnow()
+    try:
+        analyte_history_collection.bulk_write([
+            UpdateOne(
+                {"patient_id": patient_id, "file_hash": file_hash, "analyte": value["analyte"], "unit": value["unit"]},
+                {"$setOnInsert": {
+                    "task_id": task_id,
+                    "taken_at": taken_at,
+                    "value": value["value"],
+                    "low": value["low"],
+                    "high": value["high"],
+                    "created_at": now,
+                }},
+                upsert=True
+            )
+            for value in values
+        ], ordered=False)
+    except BulkWriteError as e:
+        # Two jobs for the same report recorded it at once; the values are the same
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+
+def get_analyte_history(patient_id: str, analyte: str = None, exclude_file_hash: str = None) -> list:
+    """
+    Retrieves a patient's readings, ordered by analyte and date, from the (patient_id, analyte, taken_at)
+    index. `exclude_file_hash` leaves out the readings of one report, e.g. the one being analysed.
+    """
+    query = {"patient_id": patient_id}
+    if analyte:
+        query["analyte"] = analyte
+    if exclude_file_hash:
+        query["file_hash"] = {"$ne": exclude_file_hash}
+    projection = {"_id": 0, "analyte": 1, "unit": 1, "taken_at": 1, "value": 1, "low": 1, "high": 1, "file_hash": 1}
+    return list(analyte_history_collection.find(query, projection).sort([("analyte", ASCENDING), ("taken_at", ASCENDING)]))
@@ -0,0 +1,153 @@
+# handoff.py
+import os
+import re
+import json
+import logging
+from typing import List, TypedDict
+from dotenv import load_dotenv
+from metrics import record
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Most tokens the outputs handed to one stage may take together; larger contexts are trimmed
+HANDOFF_CONTEXT_TOKEN_BUDGET = int(os.getenv("HANDOFF_CONTEXT_TOKEN_BUDGET", 4000))
+# Size of the doctor's notes when the doctor did not write a Handoff Notes section
+HANDOFF_NOTES_TOKEN_BUDGET = int(os.getenv("HANDOFF_NOTES_TOKEN_BUDGET", 300))
+HANDOFF_MAX_NOTES = int(os.getenv("HANDOFF_MAX_NOTES", 8))
+HANDOFF_NOTE_CHARS = 240
+# The tokenizer used to count context sizes (the agents' model)
+HANDOFF_TOKEN_MODEL = os.getenv("HANDOFF_TOKEN_MODEL", "gemini/gemini-2.0-flash")
+
+# The stage whose analysis is handed off to the others in compact form
+HANDOFF_SOURCE = "doctor"
+# Stages that write for the patient, and so receive their dependencies' prose rather than the compact handoff
+PROSE_STAGES = {"compile"}
+
+# The heading task.py asks the doctor to put the notes for the specialists under
+NOTES_HEADING = re.compile(r"^[#*\s]*handoff notes[*:\s]*$", re.IGNORECASE | re.MULTILINE)
+NOTE_LINE = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+(?P<note>.+)$")
+
+class Finding(TypedDict):
+    """One out-of-range test result, as summarize_findings lists it under 'abnormal'."""
+    analyte: str
+    value: float
+    unit: str
+    reference: str
+    flag: str
+
+class Handoff(TypedDict):
+    """What the doctor hands the specialists in place of their full analysis."""
+    abnormal: List[Finding]
+    notes: List[str]
+
+def count_tokens(text: str) -> int:
+    """Counts tokens with LiteLLM's tokenizer for the agents' model, or estimates ~4 characters per token."""
+    if not text:
+        return 0
+    try:
+        from litellm import token_counter
+        return token_counter(model=HANDOFF_TOKEN_MODEL, text=text)
+    except Exception:
+        return len(text) // 4 + 1
+
+def render_findings(findings: dict) -> str:
+    """
+    Renders the parsed findings as compact lines, one per abnormal value, followed by the names of the
+    tests within range. Carries the same facts as their JSON in a fraction of the tokens.
+    """
+    lines = [f"Tests checked: {findings.get('analytes_checked', 0)}", "Abnormal (test: value unit, reference, flag):"]
+    lines += [_finding_line(finding) for finding in findings.get("abnormal", [])] or ["none"]
+    lines.append(f"Within range: {', '.join(findings.get('within_range', [])) or 'none'}")
+    return "\n".join(lines)
+
+def _finding_line(finding: Finding) -> str:
+    value = f"{finding['value']:g}" if isinstance(finding["value"], (int, float)) else finding["value"]
+    unit = f" {finding['unit']}" if finding.get("unit") else ""
+    return f"- {finding['analyte']}: {value}{unit}, ref {finding['reference']}, {finding['flag']}"
+
+def split_notes(doctor_output: str):
+    """Splits the doctor's output into the analysis for the patient and the Handoff Notes section, if any."""
+    match = NOTES_HEADING.search(doctor_output or "")
+    if not match:
+        return doctor_output or "", None
+    return doctor_output[:match.start()].rstrip(), doctor_output[match.end():]
+
+def patient_facing(output: str) -> str:
+    """An output without the doctor's notes for the specialists."""
+    return split_notes(output)[0]
+
+def build_handoff(findings: dict, doctor_output: str) -> Handoff:
+    """Builds the specialists' handoff: the abnormal findings, and the doctor's notes as short lines."""
+    analysis, notes_section = split_notes(doctor_output)
+    notes = []
+    if notes_section is not None:
+        for line in notes_section.splitlines():
+            match = NOTE_LINE.match(line)
+            if match:
+                notes.append(match.group("note").strip()[:HANDOFF_NOTE_CHARS])
+            elif notes and line.strip().startswith("#"):
+                break
+    if not notes and analysis:
+        # No usable notes: fall back to the start of the doctor's analysis, within a small budget
+        notes = [trim_to_tokens(analysis, HANDOFF_NOTES_TOKEN_BUDGET)]
+    return {"abnormal": findings.get("abnormal", []), "notes": notes[:HANDOFF_MAX_NOTES]}
+
+def render_handoff(handoff: Handoff) -> str:
+    lines = ["Abnormal findings (test: value unit, reference, flag):"]
+    lines += [_finding_line(finding) for finding in handoff["abnormal"]] or ["none"]
+    lines.append("Doctor's notes:")
+    lines += [f"- {note}" for note in handoff["notes"]] or ["none"]
+    return "\n".join(lines)
+
+def trim_to_tokens(text: str, budget: int, tokens: int = None) -> str:
+    """Keeps the whole lines from the start of `text` that fit in `budget` tokens, marking what was cut."""
+    tokens = count_tokens(text) if tokens is None else tokens
+    if tokens <= budget:
+        return text
+    max_chars = int(len(text) * budget / tokens)
+    kept = text[:max_chars]
+    if "\n" in kept:
+        kept = kept[:kept.rindex("\n")]
+    return f"{kept.rstrip()}\n[... trimmed {tokens - budget} tokens to fit the context budget]"
+
+def fit_to_budget(outputs: dict, budget: int) -> dict:
+    """
+    Trims the outputs so together they fit in `budget` tokens. Each gets an equal share, and the share a
+    short output does not use goes to the longer ones, so only the outputs that are too long are cut.
+    """
+    sizes = {name: count_tokens(text) for name, text in outputs.items()}
+    if sum(sizes.values()) <= budget:
+        return outputs
+    shares, remaining = {}, budget
+    for name in sorted(outputs, key=sizes.get):
+        shares[name] = min(sizes[name], remaining // (len(outputs) - len(shares)))
+        remaining -= shares[name]
+    return {name: trim_to_tokens(text, shares[name], sizes[name]) for name, text in outputs.items()}
+
+def stage_context(stage: str, dependency_outputs: dict, findings: dict) -> dict:
+    """
+    Returns what `stage` receives from each of its dependencies: the compact handoff in place of the doctor's
+    analysis for the specialists, prose without the handoff notes for PROSE_STAGES, all within
+    HANDOFF_CONTEXT_TOKEN_BUDGET. Logs and records the size of the stage's context before and after compaction.
+    """
+    context = {}
+    for dependency, output in dependency_outputs.items():
+        if dependency == HANDOFF_SOURCE and stage not in PROSE_STAGES:
+            context[dependency] = render_handoff(build_handoff(findings, output))
+        else:
+            context[dependency] = patient_facing(output)
+    context = fit_to_budget(context, HANDOFF_CONTEXT_TOKEN_BUDGET)
+
+    if dependency_outputs:
+        before = sum(count_tokens(output) for output in dependency_outputs.values())
+        after = sum(count_tokens(text) for text in context.values())
+    else:
+        # A first stage reads the findings (see render_findings) instead, which used to be sent as JSON
+        before = count_tokens(json.dumps(findings, ensure_ascii=False))
+        after = count_tokens(render_findings(findings))
+    record("context_tokens_before", before)
+    record("context_tokens_after", after)
+    logger.info(f"Stage '{stage}': context of {before} tokens handed off as {after} tokens.")
+    return context
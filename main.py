@@ -1,74 +1,536 @@
 # main.py
 import os
+import re
+import json
 import uuid
+import asyncio
+import hashlib
 import logging
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks, status
-from fastapi.responses import JSONResponse
+import zipfile
+from typing import List
+from datetime import datetime, timedelta
+from collections import Counter
+from celery import group
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks, Request, status
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
 
-# Import the Celery task and database functions
-from worker import process_report_task
-from database import create_analysis_task, get_analysis_task
+# Import the Celery client and database functions. Jobs are sent by task name, so the API does not
+# import worker.py and the agent stack behind it.
+from celery_client import process_report_signature
+from database import (
+    run_db, new_task_document, create_analysis_tasks, get_analysis_task_status, get_analysis_task_result,
+    complete_analysis_tasks, claim_cached_result, resolve_cached_result, fail_pending_tasks, create_analysis_batch,
+    get_analysis_batch, get_batch_tasks, count_tasks_by_status, get_analyte_history, ensure_indexes
+)
+from cache import result_cache_key
+from pipeline import ANALYSIS_MODES, DEFAULT_MODE
+from admission import admission, ADMISSION_MAX_WAIT_SECONDS
+from trends import compute_trends
+from blob_store import store_report, release_report
+from progress import progress_hub
+from metrics import registry, series_name, queue_depths, render_prometheus, METRICS_PREFIX
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Upload settings
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+MAX_BATCH_UPLOAD_BYTES = int(os.getenv("MAX_BATCH_UPLOAD_BYTES", 500 * 1024 * 1024))
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", 100))
+PDF_MAGIC = b"%PDF-"
+ZIP_MAGIC = b"PK\x03\x04"
+FILE_TYPES = {PDF_MAGIC: "a PDF", ZIP_MAGIC: "a ZIP archive"}
+ZIP_ENCRYPTED_FLAG = 0x1
+ZIP_COMPRESSION_METHODS = {zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA}
+DEFAULT_QUERY = "Summarise my Blood Test Report"
+# Largest request body each upload endpoint accepts: its files, plus room for the form fields and multipart headers
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+MAX_REQUEST_BYTES = {
+    "/analyze": MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+    "/analyze/batch": MAX_BATCH_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+}
+
+# Progress streaming settings
+PROGRESS_HEARTBEAT_SECONDS = float(os.getenv("PROGRESS_HEARTBEAT_SECONDS", 15))
+# Without Redis pub/sub the stream falls back to checking the task status this often
+PROGRESS_POLL_SECONDS = float(os.getenv("PROGRESS_POLL_SECONDS", 2))
+PROGRESS_STREAM_TIMEOUT_SECONDS = float(os.getenv("PROGRESS_STREAM_TIMEOUT_SECONDS", 3600))
+
 app = FastAPI(title="Blood Test Report Analyser API")
 
+class RequestSizeLimitMiddleware:
+    """
+    Rejects an upload larger than MAX_REQUEST_BYTES allows for its endpoint with a 413 before its body is
+    parsed: straight away when its Content-Length says so, or as soon as a chunked body grows past the limit.
+    FastAPI spools the whole multipart body to a temporary file before a handler runs, so this is the only
+    place an oversized upload can be turned away before it is received in full.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        limit = MAX_REQUEST_BYTES.get(scope["path"]) if scope["type"] == "http" and scope["method"] == "POST" else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+        detail = f"The request exceeds the {limit} byte limit."
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > limit:
+            return await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
+
+        received = 0
+        async def receive_within_limit():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise HTTPException(status_code=413, detail=detail)
+            return message
+        await self.app(scope, receive_within_limit, send)
+
+app.add_middleware(RequestSizeLimitMiddleware)
+
+@app.on_event("startup")
+async def create_indexes():
+    """Creates the database's indexes before the API serves its first request."""
+    await run_db(ensure_indexes)
+
+@app.on_event("startup")
+async def start_progress_hub():
+    """Subscribes to the workers' progress events before the first stream is opened."""
+    progress_hub.start()
+
+async def save_upload(file: UploadFile, file_path: str, magic: bytes = PDF_MAGIC, max_bytes: int = MAX_UPLOAD_BYTES):
+    """
+    Copies an upload to disk chunk by chunk, hashing it on the way, so at most one chunk is held in memory.
+    By the time a handler runs, the whole request body has been received and spooled to a temporary file,
+    so the request itself is bounded by RequestSizeLimitMiddleware; this only bounds each file at max_bytes.
+    Rejects files that don't start with the expected magic bytes or grow past max_bytes.
+    Returns the SHA-256 hex digest and the size of the saved file.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    f = await run_in_threadpool(open, file_path, "wb")
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            if size == 0 and not chunk.startswith(magic):
+                raise HTTPException(status_code=415, detail=f"The uploaded file is not {FILE_TYPES[magic]}.")
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"The uploaded file exceeds the {max_bytes} byte limit.")
+            sha256.update(chunk)
+            # Disk writes happen off the event loop
+            await run_in_threadpool(f.write, chunk)
+        if size == 0:
+            raise HTTPException(status_code=415, detail="The uploaded file is empty.")
+    except BaseException:
+        await run_in_threadpool(f.close)
+        await run_in_threadpool(os.remove, file_path)
+        raise
+    await run_in_threadpool(f.close)
+    return sha256.hexdigest(), size
+
+def new_report(file_name: str) -> dict:
+    """Allocates a task ID and a storage path for an uploaded report."""
+    return {
+        "task_id": str(uuid.uuid4()),
+        "file_path": f"data/blood_test_report_{uuid.uuid4()}.pdf",
+        "file_name": file_name,
+    }
+
+def extract_zip_reports(zip_path: str, max_reports: int = MAX_BATCH_FILES):
+    """
+    Copies every PDF in a ZIP archive to its own report file, hashing it on the way.
+    Members are streamed and capped at MAX_UPLOAD_BYTES of actual output, whatever their headers claim,
+    and extraction stops once more than max_reports PDFs have been found.
+    Returns the extracted reports and a list of rejected members.
+    """
+    reports, rejected = [], []
+    try:
+        with zipfile.ZipFile(zip_path) as archive:
+            for member in archive.infolist():
+                if len(reports) > max_reports:
+                    break
+                if member.is_dir() or os.path.basename(member.filename).startswith("."):
+                    continue
+                # Encrypted members and unsupported compression methods only reject the member
+                if member.flag_bits & ZIP_ENCRYPTED_FLAG or member.compress_type not in ZIP_COMPRESSION_METHODS:
+                    rejected.append({
+                        "file_name": member.filename, "error": "The file is encrypted or compressed with an unsupported method."
+                    })
+                    continue
+                report = new_report(member.filename)
+                sha256, size, error = hashlib.sha256(), 0, None
+                try:
+                    with archive.open(member) as source, open(report["file_path"], "wb") as target:
+                        while chunk := source.read(UPLOAD_CHUNK_SIZE):
+                            if size == 0 and not chunk.startswith(PDF_MAGIC):
+                                error = "The file is not a PDF."
+                                break
+                            size += len(chunk)
+                            if size > MAX_UPLOAD_BYTES:
+                                error = f"The file exceeds the {MAX_UPLOAD_BYTES} byte limit."
+                                break
+                            sha256.update(chunk)
+                            target.write(chunk)
+                # So does corrupt data
+                except zipfile.BadZipFile:
+                    error = "The file is corrupt."
+                except BaseException:
+                    remove_files(report["file_path"])
+                    raise
+                if error or size == 0:
+                    remove_files(report["file_path"])
+                    rejected.append({"file_name": member.filename, "error": error or "The file is empty."})
+                    continue
+                report["file_hash"] = sha256.hexdigest()
+                reports.append(report)
+    except BaseException:
+        # Nothing extracted so far is handed to the caller
+        remove_files(*(report["file_path"] for report in reports))
+        raise
+    return reports, rejected
+
+def remove_files(*file_paths: str):
+    """Removes the files that are still there."""
+    for file_path in file_paths:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+# Patient IDs are opaque references to the caller's own records, e.g. an MRN or a UUID
+PATIENT_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+def validate_patient_id(patient_id: str):
+    """Rejects malformed patient IDs with a 400. Returns the ID, or None when none was given."""
+    if not patient_id:
+        return None
+    if not PATIENT_ID.match(patient_id):
+        raise HTTPException(
+            status_code=400, detail="patient_id must be 1-128 letters, digits, '.', '_', ':' or '-'."
+        )
+    return patient_id
+
+def validate_mode(mode: str) -> str:
+    """Rejects an unknown analysis mode with a 400 listing the supported ones."""
+    if mode not in ANALYSIS_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown mode '{mode}'. Supported modes: {', '.join(ANALYSIS_MODES)}.")
+    return mode
+
+def admit(lane: str, mode: str, jobs: int = 1) -> dict:
+    """
+    Asks admission control whether a lane can take `jobs` more jobs. Rejects them with a 429 and a
+    Retry-After header while the lane's queues are over their limits; otherwise returns the wait estimates.
+    """
+    decision = admission.admit(lane, mode, jobs)
+    if not decision["admitted"]:
+        raise HTTPException(
+            status_code=429,
+            detail={
+                "message": "The service is busy. Please retry later.",
+                "queued": decision["queued"],
+                "retry_after_seconds": decision["retry_after_seconds"],
+            },
+            headers={"Retry-After": str(decision["retry_after_seconds"])}
+        )
+    return decision
+
+def completion_estimate(decision: dict) -> dict:
+    """The estimated queueing time and completion time of an admitted job, for the response."""
+    return {
+        "estimated_wait_seconds": decision["estimated_wait_seconds"],
+        "estimated_completion_at": datetime.utcnow() + timedelta(seconds=decision["estimated_seconds"]),
+    }
+
+def dispatch_reports(reports: list, query: str, batch_id: str = None, mode: str = DEFAULT_MODE, lane: str = "interactive",
+                     patient_id: str = None) -> list:
+    """
+    Registers saved reports and gets each one analysed with as few crew runs as possible:
+    task records are created in one bulk insert, cached results complete at once in one bulk update,
+    duplicates of in-flight jobs are coalesced onto them, and the rest are enqueued as one Celery group.
+    Each report is a dict with task_id, file_path, file_name and file_hash. The saved file is moved into
+    the blob store for a queued job (once per distinct report), and removed otherwise.
+    Jobs run on the queues of their `lane`: "interactive" for single reports, "bulk" for batches.
+    Reports with a `patient_id` are analysed against, and added to, that patient's analyte history.
+    If any step fails, the tasks it created that have not settled are failed and its cache claims released.
+    Returns the outcome for each report, in order: "QUEUED", "CACHED" or "COALESCED".
+    """
+    for report in reports:
+        report["cache_key"] = result_cache_key(report["file_hash"], query, mode, patient_id)
+
+    outcomes, cached_results, signatures, claimed = [], {}, [], []
+    try:
+        # 1. Create the records in the database
+        create_analysis_tasks([
+            new_task_document(report["task_id"], report["file_name"], query, report["cache_key"], batch_id, mode, lane, patient_id)
+            for report in reports
+        ])
+
+        # 2. Serve identical reports from the cache, or attach them to an identical job already running
+        for report in reports:
+            task_id = report["task_id"]
+            # The claim outlives the longest the job may wait in its lane's queues
+            cached = claim_cached_result(report["cache_key"], task_id, ADMISSION_MAX_WAIT_SECONDS[lane])
+            if cached is None:
+                claimed.append(report)
+                store_report(task_id, report["file_hash"], report["file_path"])
+                signatures.append(process_report_signature(task_id, report["file_hash"], query, report["cache_key"], lane))
+                outcomes.append("QUEUED")
+                continue
+            # The saved copy is not needed when no new job is enqueued
+            os.remove(report["file_path"])
+            if cached["status"] == "READY":
+                cached_results[task_id] = cached["result"]
+                outcomes.append("CACHED")
+                logging.info(f"Task {task_id} served from the result cache.")
+            else:
+                outcomes.append("COALESCED")
+                logging.info(f"Task {task_id} coalesced onto in-flight task {cached['task_id']}.")
+        if cached_results:
+            complete_analysis_tasks(cached_results)
+
+        # 3. Enqueue the remaining reports with Celery
+        if signatures:
+            group(signatures).apply_async()
+            logging.info(f"{len(signatures)} task(s) queued for processing.")
+    except Exception as e:
+        # The request fails as a whole: every task it created that has not settled fails with it, rather than
+        # staying PENDING until it expires. The claimed jobs were never enqueued, so their claims are released
+        # too, and identical reports (and the tasks coalesced onto them) do not wait on a job that never runs.
+        error = f"The report could not be queued for analysis: {e}"
+        fail_pending_tasks([report["task_id"] for report in reports], error)
+        for report in claimed:
+            resolve_cached_result(report["cache_key"], report["task_id"], "FAILED", error)
+            release_report(report["task_id"], report["file_hash"])
+        raise
+    registry.add({
+        series_name(f"{METRICS_PREFIX}reports_total", outcome=outcome): count for outcome, count in Counter(outcomes).items()
+    })
+    return outcomes
+
 @app.get("/")
 async def root():
     """Health check endpoint."""
     return {"message": "Blood Test Report Analyser API is running"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def export_metrics():
+    """
+    Exports metrics in the Prometheus text format: per-stage durations, LLM calls, tokens, retries,
+    backoff and cache hits recorded by the workers, worker busy time, queue depth and tasks by status.
+    """
+    series = await run_in_threadpool(registry.snapshot)
+    gauges = {
+        series_name(f"{METRICS_PREFIX}queue_depth", queue=queue): depth
+        for queue, depth in (await run_in_threadpool(queue_depths)).items()
+    }
+    for task_status, count in (await run_db(count_tasks_by_status)).items():
+        gauges[series_name(f"{METRICS_PREFIX}tasks", status=task_status)] = count
+    return PlainTextResponse(render_prometheus(series, gauges), media_type="text/plain; version=0.0.4")
+
 @app.post("/analyze", status_code=status.HTTP_202_ACCEPTED)
 async def analyze_blood_report(
     file: UploadFile = File(...),
-    query: str = Form(default="Summarise my Blood Test Report")
+    query: str = Form(default=DEFAULT_QUERY),
+    mode: str = Form(default=DEFAULT_MODE),
+    patient_id: str = Form(default=None)
 ):
     """
     Accepts a blood test report, saves it, and queues it for analysis.
-    Returns a task ID for polling the result.
+    `mode` picks the stages that run: summary (doctor only), nutrition, fitness, or full (every stage).
+    With a `patient_id`, the doctor also sees the trends of the patient's earlier reports (see /trends).
+    Returns a task ID for polling the result and an estimated completion time, or a 429 with
+    Retry-After while the interactive lane is overloaded.
     """
-    task_id = str(uuid.uuid4())
-    file_id = str(uuid.uuid4())
-    file_path = f"data/blood_test_report_{file_id}.pdf"
+    validate_mode(mode)
+    patient_id = validate_patient_id(patient_id)
+    decision = await run_in_threadpool(admit, "interactive", mode)
+    report = new_report(file.filename)
+    task_id = report["task_id"]
     
     try:
         # Create a directory to store uploaded files
         os.makedirs("data", exist_ok=True)
         
-        # Save the uploaded file
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        # Stream the uploaded file to disk, validating and hashing it as it arrives
+        report["file_hash"], file_size = await save_upload(file, report["file_path"])
+        logging.info(f"Task {task_id} received file: {file.filename} ({file_size} bytes)")
         
         # Ensure query is not empty
         if not query or not query.strip():
-            query = "Summarise my Blood Test Report"
-            
-        # 1. Create a record in the database
-        create_analysis_task(task_id, file_name=file.filename, query=query)
-        logging.info(f"Task {task_id} created for file: {file.filename}")
-
-        # 2. Enqueue the background task with Celery
-        process_report_task.delay(task_id, file_path, query)
-        logging.info(f"Task {task_id} queued for processing.")
+            query = DEFAULT_QUERY
         
-        return {
-            "message": "Analysis has been started. Please check the result later.",
+        [outcome] = await run_in_threadpool(
+            dispatch_reports, [report], query, None, mode, "interactive", patient_id
+        )
+        
+        response = {
+            "message": "Analysis was served from cache." if outcome == "CACHED" else "Analysis has been started. Please check the result later.",
             "task_id": task_id,
+            "mode": mode,
             "status_endpoint": f"/result/{task_id}"
         }
+        if outcome != "CACHED":
+            response.update(completion_estimate(decision))
+        return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error in /analyze endpoint: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+    finally:
+        # dispatch_reports moves or removes the report once it is queued; a copy left here was never queued
+        await run_in_threadpool(remove_files, report["file_path"])
+
+@app.post("/analyze/batch", status_code=status.HTTP_202_ACCEPTED)
+async def analyze_blood_report_batch(
+    files: List[UploadFile] = File(...),
+    query: str = Form(default=DEFAULT_QUERY),
+    mode: str = Form(default=DEFAULT_MODE),
+    patient_id: str = Form(default=None)
+):
+    """
+    Accepts many blood test reports at once, as PDFs and/or ZIP archives of PDFs, and queues them for analysis.
+    Every report is analysed in the same `mode` (see /analyze), on the bulk lane's queues. A `patient_id`
+    marks every report as the same patient's, e.g. to upload their earlier reports in one go.
+    Returns a batch ID for polling the progress of every report in one request, or a 429 with
+    Retry-After while the bulk lane is overloaded.
+    """
+    validate_mode(mode)
+    patient_id = validate_patient_id(patient_id)
+    # Checked again below once ZIP archives are extracted
+    decision = await run_in_threadpool(admit, "bulk", mode, len(files))
+    batch_id = str(uuid.uuid4())
+    reports, rejected = [], []
+    
+    try:
+        os.makedirs("data", exist_ok=True)
+        if not query or not query.strip():
+            query = DEFAULT_QUERY
+
+        for file in files:
+            try:
+                if (file.filename or "").lower().endswith(".zip"):
+                    zip_path = f"data/batch_{batch_id}_{uuid.uuid4()}.zip"
+                    await save_upload(file, zip_path, magic=ZIP_MAGIC, max_bytes=MAX_BATCH_UPLOAD_BYTES)
+                    try:
+                        extracted, skipped = await run_in_threadpool(
+                            extract_zip_reports, zip_path, MAX_BATCH_FILES - len(reports)
+                        )
+                    except zipfile.BadZipFile:
+                        raise HTTPException(status_code=415, detail="The uploaded file is not a valid ZIP archive.")
+                    finally:
+                        await run_in_threadpool(os.remove, zip_path)
+                    reports.extend(extracted)
+                    rejected.extend(skipped)
+                else:
+                    report = new_report(file.filename)
+                    report["file_hash"], _ = await save_upload(file, report["file_path"])
+                    reports.append(report)
+            except HTTPException as e:
+                rejected.append({"file_name": file.filename, "error": e.detail})
+
+            if len(reports) > MAX_BATCH_FILES:
+                raise HTTPException(status_code=413, detail=f"A batch may contain at most {MAX_BATCH_FILES} reports.")
+
+        if not reports:
+            raise HTTPException(status_code=400, detail={"message": "No valid PDF reports were uploaded.", "rejected": rejected})
+
+        # ZIP archives held more reports than files were uploaded
+        if len(reports) > len(files):
+            decision = await run_in_threadpool(admit, "bulk", mode, len(reports))
+
+        await run_db(
+            create_analysis_batch, batch_id, [report["task_id"] for report in reports], query, rejected
+        )
+        outcomes = await run_in_threadpool(dispatch_reports, reports, query, batch_id, mode, "bulk", patient_id)
+        logging.info(f"Batch {batch_id} created with {len(reports)} report(s): {dict(Counter(outcomes))}")
+
+        return {
+            "message": "Batch analysis has been started. Please check the progress later.",
+            "batch_id": batch_id,
+            "accepted": len(reports),
+            "rejected": rejected,
+            "task_ids": [report["task_id"] for report in reports],
+            "mode": mode,
+            "status_endpoint": f"/batch/{batch_id}",
+            **completion_estimate(decision)
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error in /analyze/batch endpoint: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+    finally:
+        # dispatch_reports moves or removes every report it queues; whatever is left was never queued
+        await run_in_threadpool(remove_files, *(report["file_path"] for report in reports))
+
+@app.get("/batch/{batch_id}")
+async def get_batch_status(batch_id: str, include_results: bool = True):
+    """
+    Fetches the aggregated progress of a batch, with the status and any partial results of each report.
+    """
+    batch = await run_db(get_analysis_batch, batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    tasks = await run_db(get_batch_tasks, batch_id, include_results)
+    counts = Counter(task["status"] for task in tasks)
+    finished = counts["COMPLETED"] + counts["FAILED"]
+
+    items = []
+    for task in tasks:
+        item = {"task_id": task["_id"], "file_name": task["file_name"], "status": task["status"]}
+        if include_results and task["status"] == "COMPLETED":
+            item["analysis"] = task.get("result")
+        elif include_results and task["status"] == "FAILED":
+            item["error"] = task.get("result")
+        items.append(item)
+
+    return {
+        "batch_id": batch_id,
+        "status": "COMPLETED" if finished == len(tasks) else "PROCESSING",
+        "total": len(tasks),
+        "progress": round(finished / len(tasks), 3) if tasks else 1.0,
+        "counts": dict(counts),
+        "created_at": batch["created_at"],
+        "rejected": batch["rejected"],
+        "items": items
+    }
+
+@app.get("/trends/{patient_id}")
+async def get_patient_trends(patient_id: str, analyte: str = None):
+    """
+    Computes the trend of each of a patient's analytes across all their completed reports: latest and
+    previous values, the change between them, the slope per year and out-of-range streaks.
+    Pass `analyte` (e.g. Hemoglobin) to get the trend of one analyte only.
+    """
+    validate_patient_id(patient_id)
+    history = await run_db(get_analyte_history, patient_id, analyte)
+    if not history:
+        raise HTTPException(status_code=404, detail="No analyte history found for this patient")
+
+    trends = await run_in_threadpool(compute_trends, history)
+    return JSONResponse(content=jsonable_encoder({
+        "patient_id": patient_id,
+        "reports": len({reading["file_hash"] for reading in history}),
+        "readings": len(history),
+        "trends": trends
+    }))
 
 @app.get("/result/{task_id}")
 async def get_analysis_result(task_id: str):
     """
     Fetches the status and result of an analysis task by its ID.
     """
-    task = get_analysis_task(task_id)
+    # Projected read off the event loop: only the fields below are transferred
+    task = await run_db(get_analysis_task_result, task_id)
     
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
@@ -85,4 +547,62 @@ async def get_analysis_result(task_id: str):
     elif task["status"] == "FAILED":
         response["error"] = task.get("result")
         
-    return JSONResponse(content=response)
\ No newline at end of file
+    return JSONResponse(content=jsonable_encoder(response))
+
+def sse_message(event: str, data: dict) -> str:
+    """Formats one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+async def result_message(task_id: str) -> str:
+    """Builds the final SSE message for a finished task from its stored result."""
+    task = await run_db(get_analysis_task_result, task_id)
+    data = {"task_id": task_id, "type": "result", "status": task["status"]}
+    data["analysis" if task["status"] == "COMPLETED" else "error"] = task.get("result")
+    return sse_message("result", data)
+
+@app.get("/events/{task_id}")
+async def stream_analysis_progress(task_id: str, request: Request):
+    """
+    Streams the progress of an analysis task as Server-Sent Events instead of polling /result:
+    a `status` snapshot first, then a `stage` event as each stage (verification, doctor, nutrition,
+    exercise, compile) starts and finishes, and finally a `result` event with the analysis or error.
+    """
+    queue = progress_hub.subscribe(task_id)
+    task = await run_db(get_analysis_task_status, task_id)
+    if not task:
+        progress_hub.unsubscribe(task_id, queue)
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    async def event_stream():
+        try:
+            yield sse_message("status", {"task_id": task_id, "type": "status", "status": task["status"], "stages": task.get("stages", {})})
+            if task["status"] in ("COMPLETED", "FAILED"):
+                yield await result_message(task_id)
+                return
+
+            interval = PROGRESS_HEARTBEAT_SECONDS if progress_hub.available else PROGRESS_POLL_SECONDS
+            deadline = asyncio.get_running_loop().time() + PROGRESS_STREAM_TIMEOUT_SECONDS
+            while asyncio.get_running_loop().time() < deadline:
+                if await request.is_disconnected():
+                    return
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=interval)
+                except asyncio.TimeoutError:
+                    # A cheap status-only read covers missed events and deployments without Redis
+                    current = await run_db(get_analysis_task_status, task_id)
+                    if current and current["status"] in ("COMPLETED", "FAILED"):
+                        yield await result_message(task_id)
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+                yield sse_message(event["type"], event)
+                if event["type"] == "result":
+                    return
+        finally:
+            progress_hub.unsubscribe(task_id, queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
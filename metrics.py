@@ -0,0 +1,226 @@
+# metrics.py
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+import redis
+from dotenv import load_dotenv
+from cache import get_redis_client
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = "analyser_"
+# Every series lives in one Redis hash, so the API can export what all the workers recorded
+METRICS_KEY = "metrics:series"
+# Celery queues whose backlog is exported as analyser_queue_depth
+METRICS_QUEUES = [queue for queue in os.getenv("METRICS_QUEUES", "reports.cpu,reports.io,reports.cpu.bulk,reports.io.bulk").split(",") if queue]
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600)
+
+def series_name(name: str, **labels) -> str:
+    """Formats a metric name and its labels the way Prometheus expects them."""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+def histogram_increments(name: str, value: float, **labels) -> dict:
+    """Returns the bucket, sum and count increments that record one observation of a histogram."""
+    increments = {
+        series_name(f"{name}_bucket", **labels, le=str(bound)): 1 for bound in DURATION_BUCKETS if value <= bound
+    }
+    increments[series_name(f"{name}_bucket", **labels, le="+Inf")] = 1
+    increments[series_name(f"{name}_sum", **labels)] = value
+    increments[series_name(f"{name}_count", **labels)] = 1
+    return increments
+
+class MetricsRegistry:
+    """
+    Cluster-wide counters, kept in a Redis hash that every process increments.
+    Without Redis each process counts in memory, so /metrics only sees what the API process recorded.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._connected = False
+        self._local = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def _redis(self):
+        with self._lock:
+            if not self._connected:
+                self._connected = True
+                self._client = get_redis_client("metrics")
+        return self._client
+
+    def add(self, increments: dict):
+        """Applies many counter increments at once (one Redis round-trip)."""
+        if not increments:
+            return
+        client = self._redis()
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=False)
+                for series, amount in increments.items():
+                    pipe.hincrbyfloat(METRICS_KEY, series, amount)
+                pipe.execute()
+                return
+            except redis.RedisError as e:
+                logger.warning(f"Could not record metrics in Redis, counting in-process: {e}")
+        with self._lock:
+            for series, amount in increments.items():
+                self._local[series] += amount
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        self.add({series_name(METRICS_PREFIX + name, **labels): amount})
+
+    def snapshot(self) -> dict:
+        """Returns every recorded series with its current value."""
+        with self._lock:
+            series = dict(self._local)
+        client = self._redis()
+        if client is not None:
+            try:
+                for name, value in client.hgetall(METRICS_KEY).items():
+                    series[name.decode()] = series.get(name.decode(), 0) + float(value)
+            except redis.RedisError as e:
+                logger.warning(f"Could not read metrics from Redis: {e}")
+        return series
+
+registry = MetricsRegistry()
+
+class TaskMetrics:
+    """
+    What one step of an analysis job spent, in total and per stage. Added to the job's totals on the
+    task document when the step ends. `status` and `job_seconds` are set by the step that settles the job.
+    """
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.stages = defaultdict(lambda: defaultdict(float))
+        self.stage_durations = {}
+        self.status = None
+        self.job_seconds = None
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, name: str, amount: float, stage: str = None):
+        with self._lock:
+            self.totals[name] += amount
+            self.stages[stage or "none"][name] += amount
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                **self.totals,
+                "busy_seconds": self.busy_seconds,
+                "stages": {stage: dict(counters) for stage, counters in self.stages.items()},
+            }
+
+    def increments(self) -> dict:
+        """The registry increments for this job: its counters by stage, durations and outcome."""
+        increments = {}
+        with self._lock:
+            for stage, counters in self.stages.items():
+                for name, amount in counters.items():
+                    increments[series_name(f"{METRICS_PREFIX}{name}_total", stage=stage)] = amount
+            for stage, seconds in self.stage_durations.items():
+                increments.update(histogram_increments(f"{METRICS_PREFIX}stage_duration_seconds", seconds, stage=stage))
+        # A job spans several Celery tasks; its outcome is counted once, by the step that settles it
+        if self.status:
+            job_seconds = self.job_seconds if self.job_seconds is not None else self.busy_seconds
+            increments.update(histogram_increments(f"{METRICS_PREFIX}task_duration_seconds", job_seconds))
+            increments[series_name(f"{METRICS_PREFIX}tasks_total", status=self.status)] = 1
+        increments[series_name(f"{METRICS_PREFIX}worker_busy_seconds_total")] = self.busy_seconds
+        return increments
+
+_current_task = contextvars.ContextVar("current_task_metrics", default=None)
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+
+@contextmanager
+def track_task():
+    """
+    Collects the metrics of the job running in this context and publishes them when it ends.
+    Each Celery task of a job (parsing, every stage, settling) tracks its own metrics, which
+    database.save_task_metrics adds up on the job's task record.
+    """
+    task_metrics = TaskMetrics()
+    token = _current_task.set(task_metrics)
+    stage_token = _current_stage.set(None)
+    registry.inc("worker_tasks_in_progress")
+    started = time.perf_counter()
+    try:
+        yield task_metrics
+    finally:
+        task_metrics.busy_seconds = time.perf_counter() - started
+        _current_task.reset(token)
+        _current_stage.reset(stage_token)
+        registry.add({**task_metrics.increments(), series_name(f"{METRICS_PREFIX}worker_tasks_in_progress"): -1})
+
+def set_stage(stage: str):
+    """Attributes what is recorded from now on in this context (thread) to a pipeline stage."""
+    _current_stage.set(stage)
+
+def record(name: str, amount: float = 1):
+    """Adds to a counter of the current job and stage, or straight to the registry outside of a job."""
+    task_metrics = _current_task.get()
+    if task_metrics is not None:
+        task_metrics.add(name, amount, _current_stage.get())
+    else:
+        registry.inc(f"{name}_total", amount, stage="none")
+
+def record_stage_duration(stage: str, seconds: float):
+    task_metrics = _current_task.get()
+    if task_metrics is not None:
+        task_metrics.stage_durations[stage] = seconds
+
+@contextmanager
+def timed(name: str):
+    """Records the time spent in the block as `<name>_seconds`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(f"{name}_seconds", time.perf_counter() - started)
+
+def queue_depths(queues: list = None) -> dict:
+    """Returns the number of jobs waiting in each Celery queue of the Redis broker (METRICS_QUEUES by default)."""
+    queues = queues or METRICS_QUEUES
+    client = registry._redis()
+    if client is None:
+        return {}
+    try:
+        pipe = client.pipeline(transaction=False)
+        for queue in queues:
+            pipe.llen(queue)
+        return dict(zip(queues, pipe.execute()))
+    except redis.RedisError as e:
+        logger.warning(f"Could not read queue depths: {e}")
+        return {}
+
+def render_prometheus(series: dict, gauges: dict) -> str:
+    """Renders counters, histograms and gauges in the Prometheus text exposition format."""
+    families = defaultdict(list)
+    for name, value in {**series, **gauges}.items():
+        families[name.split("{", 1)[0]].append((name, value))
+
+    lines, typed = [], set()
+    for family in sorted(families):
+        base = family
+        for suffix in ("_bucket", "_sum", "_count"):
+            if family.endswith(suffix) and family[:-len(suffix)] + "_count" in families:
+                base = family[:-len(suffix)]
+        if base not in typed:
+            typed.add(base)
+            if base != family:
+                kind = "histogram"
+            elif family.endswith("_total"):
+                kind = "counter"
+            else:
+                kind = "gauge"
+            lines.append(f"# TYPE {base} {kind}")
+        lines.extend(f"{name} {value}" for name, value in sorted(families[family]))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,123 @@
+# pdf_extraction.py
+import os
+import math
+import mmap
+import hashlib
+import logging
+from contextlib import contextmanager
+import pdfplumber
+from dotenv import load_dotenv
+from metrics import record, timed
+from cache import DiskCache
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Extraction settings. Every prefork child of the CPU worker starts its own pool, so the default is serial
+# extraction; opt in with at most the host's cores divided by the worker's --concurrency.
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", 1))
+# Below this many pages the process pool costs more than it saves
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", 8))
+PDF_TEXT_CACHE_DIR = os.getenv("PDF_TEXT_CACHE_DIR", "data/.text_cache")
+# The cache only spares retries and duplicate uploads a second parse; it holds the patients' results, so it
+# keeps them briefly and is capped
+PDF_TEXT_CACHE_MAX_ENTRIES = int(os.getenv("PDF_TEXT_CACHE_MAX_ENTRIES", 1000))
+PDF_TEXT_CACHE_TTL_SECONDS = int(os.getenv("PDF_TEXT_CACHE_TTL_SECONDS", 24 * 3600))
+# Bump when the extraction output changes so stale cache files are ignored
+EXTRACTOR_VERSION = "3"
+
+_executor = None
+_executor_pid = None
+
+@contextmanager
+def _mapped(file_path: str):
+    """
+    Maps a file read-only into memory. Reads go straight to the OS page cache, which every process
+    reading the same report (including the extraction pool) shares, instead of through private buffers.
+    """
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        yield mapped
+
+def file_sha256(file_path: str) -> str:
+    """Hashes a file through a memory map."""
+    if os.path.getsize(file_path) == 0:
+        return hashlib.sha256().hexdigest()
+    with _mapped(file_path) as mapped:
+        return hashlib.sha256(mapped).hexdigest()
+
+def _page_contents(pages) -> list:
+    contents = []
+    for page in pages:
+        contents.append((page.extract_text() or "", page.extract_tables()))
+        # Drop the parsed layout objects right away to keep long reports from piling up in memory
+        page.close()
+    return contents
+
+def _extract_page_range(file_path: str, start: int, stop: int) -> list:
+    """Extracts the text and tables of pages [start, stop) of a PDF. Runs inside a pool process."""
+    with _mapped(file_path) as mapped, pdfplumber.open(mapped, pages=range(start + 1, stop + 1)) as pdf:
+        return _page_contents(pdf.pages)
+
+def _get_executor():
+    """
+    Returns the shared process pool, or None when PDF_EXTRACT_WORKERS turns it off. The pool is billiard's
+    (Celery's fork of multiprocessing), whose processes may be started from a daemonic process: Celery
+    prefork children, which run the CPU queue, are daemonic and could not start a multiprocessing pool.
+    """
+    global _executor, _executor_pid
+    if PDF_EXTRACT_WORKERS < 2:
+        return None
+    # A pool inherited through fork (e.g. by a prefork child) belongs to the parent and cannot be used
+    if _executor is None or _executor_pid != os.getpid():
+        from billiard.pool import Pool
+        _executor = Pool(processes=PDF_EXTRACT_WORKERS)
+        _executor_pid = os.getpid()
+    return _executor
+
+def _extract_pages(file_path: str) -> list:
+    """Extracts every page's text and tables, spreading contiguous page ranges across the process pool."""
+    with _mapped(file_path) as mapped, pdfplumber.open(mapped) as pdf:
+        page_count = len(pdf.pages)
+        executor = _get_executor() if page_count >= PDF_PARALLEL_MIN_PAGES else None
+        if executor is None:
+            return _page_contents(pdf.pages)
+
+    step = math.ceil(page_count / PDF_EXTRACT_WORKERS)
+    results = [
+        executor.apply_async(_extract_page_range, (file_path, start, min(start + step, page_count)))
+        for start in range(0, page_count, step)
+    ]
+    return [content for result in results for content in result.get()]
+
+def _text_cache() -> DiskCache:
+    return DiskCache(PDF_TEXT_CACHE_DIR, PDF_TEXT_CACHE_MAX_ENTRIES, PDF_TEXT_CACHE_TTL_SECONDS)
+
+def extract_pdf_report(file_path: str, file_hash: str = None) -> dict:
+    """
+    Returns {"text": ..., "tables": [...]} for a PDF: the text of every page, one after another and each
+    followed by a newline, and every table pdfplumber finds as a list of rows.
+    Results are cached on disk by the file's SHA-256 (see PDF_TEXT_CACHE_TTL_SECONDS), so a retry never
+    parses the same PDF twice. Pass file_hash when it is already known (e.g. for a blob from blob_store)
+    to skip hashing the file.
+    """
+    cache = _text_cache()
+    cache_key = f"{file_hash or file_sha256(file_path)}.v{EXTRACTOR_VERSION}"
+    report = cache.get(cache_key)
+    if report is not None:
+        logger.info(f"Using cached extraction for {file_path}.")
+        record("pdf_text_cache_hits")
+        return report
+
+    with timed("pdf_extraction"):
+        pages = _extract_pages(file_path)
+    report = {
+        "text": "".join(f"{page_text}\n" for page_text, _ in pages if page_text),
+        "tables": [table for _, page_tables in pages for table in page_tables],
+    }
+    cache.set(cache_key, report)
+    return report
+
+def extract_pdf_text(file_path: str) -> str:
+    """Returns the text of every page of a PDF (see extract_pdf_report)."""
+    return extract_pdf_report(file_path)["text"]
@@ -0,0 +1,117 @@
+# pipeline.py
+import logging
+from datetime import datetime
+
+# Same divider CrewAI uses when it joins several task outputs into one context
+CONTEXT_DIVIDER = "\n\n----------\n\n"
+
+# The stages each analysis mode asks for, by the names task.build_pipeline_stages gives them.
+# prune_stages adds the stages these depend on; the rest of the graph (e.g. the compiler, when only
+# one specialist runs) is skipped.
+ANALYSIS_MODES = {
+    "summary": ["doctor"],
+    "nutrition": ["nutrition"],
+    "fitness": ["exercise"],
+    "full": ["compile"],
+}
+DEFAULT_MODE = "full"
+
+# The stage graph: the stages each stage depends on, in declaration order. It is declared here, rather than
+# only read from the tasks' `context=`, so the CPU worker can plan a job's workflow without importing CrewAI
+# and the agents. build_pipeline_stages must match it (see check_stage_graph).
+STAGE_GRAPH = {
+    "doctor": [],
+    "nutrition": ["doctor"],
+    "exercise": ["doctor"],
+    "compile": ["doctor", "nutrition", "exercise"],
+}
+
+def stage_dependencies(stages: dict) -> dict:
+    """
+    Maps every stage name to the names of the stages it depends on, read from each task's `context=`.
+    Raises ValueError if a task depends on a task that is not part of `stages`.
+    """
+    names = {id(task): name for name, task in stages.items()}
+    dependencies = {}
+    for name, task in stages.items():
+        # Tasks without an explicit context carry CrewAI's NOT_SPECIFIED sentinel instead of a list
+        context = task.context if isinstance(task.context, list) else []
+        missing = [dep for dep in context if id(dep) not in names]
+        if missing:
+            raise ValueError(f"Stage '{name}' depends on a task that is not part of the pipeline.")
+        dependencies[name] = [names[id(dep)] for dep in context]
+    return dependencies
+
+def check_stage_graph(stages: dict):
+    """Raises ValueError if the tasks' `context=` dependencies differ from STAGE_GRAPH."""
+    dependencies = stage_dependencies(stages)
+    if dependencies != STAGE_GRAPH:
+        raise ValueError(f"The pipeline's tasks do not match STAGE_GRAPH: {dependencies} != {STAGE_GRAPH}")
+
+def prune_stages(dependencies: dict, mode: str = DEFAULT_MODE) -> dict:
+    """
+    Keeps only the part of a stage graph (see STAGE_GRAPH) an analysis mode needs: its target stages and,
+    transitively, every stage they depend on, in declaration order. Raises ValueError for an unknown mode.
+    """
+    if mode not in ANALYSIS_MODES:
+        raise ValueError(f"Unknown analysis mode '{mode}', expected one of: {', '.join(ANALYSIS_MODES)}.")
+    needed, pending = set(), list(ANALYSIS_MODES[mode])
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(dependencies[name])
+    return {name: deps for name, deps in dependencies.items() if name in needed}
+
+def stage_levels(dependencies: dict) -> list:
+    """
+    Groups the stages into levels that can run one after another: every stage's dependencies are in
+    earlier levels, so the stages within a level can run concurrently.
+    Raises ValueError if the stages have circular dependencies.
+    """
+    levels, placed = [], set()
+    while len(placed) < len(dependencies):
+        level = [name for name, deps in dependencies.items() if name not in placed and all(dep in placed for dep in deps)]
+        if not level:
+            raise ValueError(f"Pipeline stages have circular dependencies: {sorted(set(dependencies) - placed)}")
+        levels.append(level)
+        placed.update(level)
+    return levels
+
+def final_stage(dependencies: dict) -> str:
+    """The stage whose output is the pipeline's result: the last one that nothing else depends on."""
+    required = {dep for deps in dependencies.values() for dep in deps}
+    return [name for name in dependencies if name not in required][-1]
+
+def interpolate_inputs(tasks: list, inputs: dict):
+    """Interpolates '{query}', '{report_findings}', etc. into the tasks and their agents, the same way Crew.kickoff does."""
+    for task in tasks:
+        task.interpolate_inputs_and_add_conversation_history(inputs)
+    for agent in {id(task.agent): task.agent for task in tasks}.values():
+        agent.interpolate_inputs(inputs)
+
+def _run_stage(name: str, task, context: str, on_stage_start=None, on_stage_end=None) -> str:
+    """Executes a single CrewAI task with the combined output of its dependencies as context."""
+    started_at = datetime.utcnow()
+    if on_stage_start:
+        on_stage_start(name, started_at)
+    logging.info(f"Pipeline stage '{name}' started.")
+
+    # Mirror Crew: a task without its own tools uses its agent's tools
+    output = task.execute_sync(context=context or None, tools=task.tools or task.agent.tools)
+
+    finished_at = datetime.utcnow()
+    logging.info(f"Pipeline stage '{name}' finished in {(finished_at - started_at).total_seconds():.1f}s.")
+    if on_stage_end:
+        on_stage_end(name, started_at, finished_at)
+    return output.raw
+
+def run_stage(stages: dict, name: str, inputs: dict, dependency_outputs: dict, on_stage_start=None, on_stage_end=None) -> str:
+    """
+    Runs a single stage on its own, as one step of a job's workflow of stage tasks (see worker.stage_workflow).
+    `dependency_outputs` maps each of the stage's dependencies to the output it produced.
+    """
+    task = stages[name]
+    interpolate_inputs([task], inputs)
+    context = CONTEXT_DIVIDER.join(dependency_outputs[dep] for dep in stage_dependencies(stages)[name])
+    return _run_stage(name, task, context, on_stage_start, on_stage_end)
@@ -0,0 +1,114 @@
+# progress.py
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+import redis
+from dotenv import load_dotenv
+from cache import get_redis_client
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_CHANNEL_PREFIX = "progress:"
+# After a failed connection, Redis is tried again this often, so progress resumes once it is back
+PROGRESS_RECONNECT_SECONDS = float(os.getenv("PROGRESS_RECONNECT_SECONDS", 30))
+
+_publisher = None
+_publisher_retry_at = 0.0
+_publisher_lock = threading.Lock()
+
+def _get_publisher():
+    global _publisher, _publisher_retry_at
+    with _publisher_lock:
+        if _publisher is None and time.monotonic() >= _publisher_retry_at:
+            _publisher = get_redis_client("progress events")
+            if _publisher is None:
+                _publisher_retry_at = time.monotonic() + PROGRESS_RECONNECT_SECONDS
+    return _publisher
+
+def publish_progress(task_id: str, event: dict):
+    """
+    Publishes a progress event for a task on its Redis channel. Progress is best-effort:
+    a failure is logged and never fails the job, and clients still see the final state in Mongo.
+    """
+    client = _get_publisher()
+    if client is None:
+        return
+    try:
+        client.publish(f"{PROGRESS_CHANNEL_PREFIX}{task_id}", json.dumps({"task_id": task_id, **event}, default=str))
+    except redis.RedisError as e:
+        logger.warning(f"Could not publish progress for task {task_id}: {e}")
+
+class ProgressHub:
+    """
+    Fans progress events out to the API's streaming clients. A single background thread holds one
+    Redis pattern subscription for all tasks and hands each event to the asyncio queues of the
+    clients watching that task, so open streams cost neither a Redis connection nor a thread each.
+    """
+
+    def __init__(self):
+        self._queues = defaultdict(set)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._started = False
+        self.available = False
+
+    def start(self):
+        """
+        Starts the subscription thread; call from the event loop, e.g. when the API starts. The thread
+        connects to Redis itself, so this never blocks the loop. Without a REDIS_URL, streams poll instead.
+        """
+        with self._lock:
+            if self._started or not os.getenv("REDIS_URL"):
+                return
+            self._started = True
+            self._loop = asyncio.get_running_loop()
+        threading.Thread(target=self._listen, name="progress-hub", daemon=True).start()
+
+    def _listen(self):
+        client = None
+        while True:
+            try:
+                if client is None:
+                    # No socket timeout: the subscription may legitimately sit idle for a long time
+                    client = get_redis_client("progress streaming", socket_timeout=None)
+                    if client is None:
+                        time.sleep(PROGRESS_RECONNECT_SECONDS)
+                        continue
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f"{PROGRESS_CHANNEL_PREFIX}*")
+                self.available = True
+                for message in pubsub.listen():
+                    task_id = message["channel"].decode()[len(PROGRESS_CHANNEL_PREFIX):]
+                    with self._lock:
+                        queues = list(self._queues.get(task_id, ()))
+                    if queues:
+                        event = json.loads(message["data"])
+                        for queue in queues:
+                            self._loop.call_soon_threadsafe(queue.put_nowait, event)
+            except redis.RedisError as e:
+                # Streams keep working from their periodic status checks until the subscription is back
+                self.available = False
+                logger.warning(f"Progress subscription lost, reconnecting: {e}")
+                time.sleep(1)
+
+    def subscribe(self, task_id: str) -> asyncio.Queue:
+        """Returns a queue that receives every progress event for the task until unsubscribed."""
+        self.start()
+        with self._lock:
+            queue = asyncio.Queue()
+            self._queues[task_id].add(queue)
+        return queue
+
+    def unsubscribe(self, task_id: str, queue: asyncio.Queue):
+        with self._lock:
+            self._queues[task_id].discard(queue)
+            if not self._queues[task_id]:
+                del self._queues[task_id]
+
+progress_hub = ProgressHub()
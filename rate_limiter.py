@@ -0,0 +1,227 @@
+# rate_limiter.py
+import os
+import re
+import time
+import uuid
+import random
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+import redis
+from dotenv import load_dotenv
+from cache import get_redis_client
+from metrics import record
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Cluster-wide LLM quota, shared by every worker process using the same API key
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", 60))
+LLM_BURST = int(os.getenv("LLM_BURST", 10))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+# A concurrency slot held longer than this is assumed to belong to a dead worker
+LLM_SLOT_LEASE_SECONDS = int(os.getenv("LLM_SLOT_LEASE_SECONDS", 300))
+
+# Retry settings
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 5))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", 1))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", 60))
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_ERROR_NAMES = (
+    "RateLimitError", "ServiceUnavailableError", "APIConnectionError", "Timeout", "InternalServerError", "URLError"
+)
+
+# Refills the bucket from the elapsed time, then takes a token. Returns "0" when a token was taken,
+# otherwise the seconds until one is available. Uses the Redis clock so every host agrees on time.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+# Takes a concurrency slot if fewer than ARGV[1] unexpired holders exist. Returns 1 on success.
+SEMAPHORE_ACQUIRE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[2]))
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('ZADD', KEYS[1], now, ARGV[3])
+    redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+    return 1
+end
+return 0
+"""
+
+class TransientLLMError(Exception):
+    """Raise inside a call wrapped by call_with_backoff to retry it, e.g. on an empty response."""
+
+class _LocalBackend:
+    """In-process token bucket and semaphore, used when Redis is unavailable."""
+
+    def __init__(self, rate_per_second: float, capacity: int, max_concurrency: int):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def take_token(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate_per_second
+
+    def try_acquire_slot(self, holder: str) -> bool:
+        return self.semaphore.acquire(blocking=False)
+
+    def release_slot(self, holder: str):
+        self.semaphore.release()
+
+class _RedisBackend:
+    """Token bucket and lease-based semaphore in Redis, shared by every worker."""
+
+    def __init__(self, client, name: str, rate_per_second: float, capacity: int, max_concurrency: int):
+        self.bucket_key = f"ratelimit:{name}:bucket"
+        self.slots_key = f"ratelimit:{name}:slots"
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.max_concurrency = max_concurrency
+        self.token_bucket = client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.semaphore_acquire = client.register_script(SEMAPHORE_ACQUIRE_SCRIPT)
+        self.client = client
+
+    def take_token(self) -> float:
+        return float(self.token_bucket(keys=[self.bucket_key], args=[self.rate_per_second, self.capacity]))
+
+    def try_acquire_slot(self, holder: str) -> bool:
+        return bool(self.semaphore_acquire(
+            keys=[self.slots_key], args=[self.max_concurrency, LLM_SLOT_LEASE_SECONDS, holder]
+        ))
+
+    def release_slot(self, holder: str):
+        self.client.zrem(self.slots_key, holder)
+
+class RateLimiter:
+    """
+    Token-bucket rate limiter with a bound on concurrent calls. Backed by Redis so the limits hold
+    across every Celery worker; falls back to an in-process limiter when Redis is unavailable.
+    """
+
+    def __init__(self, name: str, requests_per_minute: float, burst: int, max_concurrency: int,
+                 wait_metric: str = "llm_rate_limit_wait_seconds"):
+        self.name = name
+        self.wait_metric = wait_metric
+        rate_per_second = requests_per_minute / 60
+        self.local = _LocalBackend(rate_per_second, burst, max_concurrency)
+        client = get_redis_client(f"the '{name}' rate limiter")
+        self.backend = _RedisBackend(client, name, rate_per_second, burst, max_concurrency) if client else self.local
+
+    def _with_fallback(self, operation: str, *args):
+        try:
+            return getattr(self.backend, operation)(*args)
+        except redis.RedisError as e:
+            logger.warning(f"Rate limiter '{self.name}' lost Redis, limiting in-process: {e}")
+            self.backend = self.local
+            return getattr(self.backend, operation)(*args)
+
+    @contextmanager
+    def slot(self):
+        """Blocks until a concurrency slot and a rate token are both available, and holds the slot while in use."""
+        holder = uuid.uuid4().hex
+        started = time.perf_counter()
+        while not self._with_fallback("try_acquire_slot", holder):
+            time.sleep(random.uniform(0.05, 0.25))
+        # Release through the backend that granted the slot, even if a fallback happens meanwhile
+        backend = self.backend
+        try:
+            while (wait := self._with_fallback("take_token")) > 0:
+                time.sleep(wait + random.uniform(0, 0.05))
+            record(self.wait_metric, time.perf_counter() - started)
+            yield
+        finally:
+            try:
+                backend.release_slot(holder)
+            except redis.RedisError as e:
+                logger.warning(f"Could not release rate limiter slot (its lease will expire): {e}")
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def llm_limiter(api_key: str) -> RateLimiter:
+    """Returns the process-wide limiter for an API key. Only a hash of the key is stored in Redis."""
+    key_id = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+    with _limiters_lock:
+        if key_id not in _limiters:
+            _limiters[key_id] = RateLimiter(f"llm:{key_id}", LLM_REQUESTS_PER_MINUTE, LLM_BURST, LLM_MAX_CONCURRENCY)
+        return _limiters[key_id]
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits, timeouts, connection errors and 5xx responses are worth retrying; anything else is not."""
+    if isinstance(error, TransientLLMError):
+        return True
+    # `code` is the status of urllib's HTTPError
+    if getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES or getattr(error, "code", None) in RETRYABLE_STATUS_CODES:
+        return True
+    return any(name in type(error).__name__ for name in RETRYABLE_ERROR_NAMES)
+
+def retry_after_seconds(error: Exception):
+    """Reads the provider's retry hint: a Retry-After header, or Gemini's "retryDelay" in the error body."""
+    response = getattr(error, "response", None)
+    headers = (
+        getattr(response, "headers", None) or getattr(error, "litellm_response_headers", None)
+        or getattr(error, "headers", None) or {}
+    )
+    retry_after = headers.get("retry-after") if hasattr(headers, "get") else None
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    match = re.search(r'retryDelay"?\s*:\s*"?(\d+(?:\.\d+)?)s', str(error))
+    return float(match.group(1)) if match else None
+
+def call_with_backoff(func, *args, max_retries: int = LLM_MAX_RETRIES, metric: str = "llm", **kwargs):
+    """
+    Calls func, retrying retryable errors with exponential backoff and full jitter.
+    A retry-after hint from the provider takes precedence over the computed delay.
+    Retries are recorded as `<metric>_retries` and `<metric>_backoff_seconds`.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = retry_after_seconds(e)
+            if delay is None:
+                delay = random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt))
+            logger.warning(f"{metric.upper()} call attempt {attempt + 1} failed ({type(e).__name__}). Retrying in {delay:.1f} seconds...")
+            record(f"{metric}_retries")
+            record(f"{metric}_backoff_seconds", delay)
+            time.sleep(delay)
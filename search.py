@@ -0,0 +1,180 @@
+# search.py
+import os
+import re
+import json
+import math
+import logging
+import threading
+import urllib.request
+from collections import Counter
+from typing import Type
+from pydantic import BaseModel, Field
+from crewai.tools.base_tool import BaseTool
+from dotenv import load_dotenv
+from cache import TieredCache, SingleFlight, make_cache_key
+from rate_limiter import RateLimiter, call_with_backoff
+from metrics import record, timed
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# "serper" searches the web through Serper; "local" searches the bundled knowledge index, with no network.
+# Without a SERPER_API_KEY the local index is used.
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND") or ("serper" if os.getenv("SERPER_API_KEY") else "local")
+SEARCH_KNOWLEDGE_PATH = os.getenv(
+    "SEARCH_KNOWLEDGE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge", "health_guidance.json")
+)
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", 5))
+SEARCH_TIMEOUT_SECONDS = float(os.getenv("SEARCH_TIMEOUT_SECONDS", 10))
+SEARCH_MAX_RETRIES = int(os.getenv("SEARCH_MAX_RETRIES", 3))
+SERPER_URL = "https://google.serper.dev/search"
+# Serper's quota is shared by every worker, like the LLM's
+SEARCH_REQUESTS_PER_MINUTE = float(os.getenv("SEARCH_REQUESTS_PER_MINUTE", 300))
+SEARCH_BURST = int(os.getenv("SEARCH_BURST", 20))
+SEARCH_MAX_CONCURRENCY = int(os.getenv("SEARCH_MAX_CONCURRENCY", 8))
+
+# Words that do not change what a health search finds; dropped before results are cached
+STOPWORDS = set(
+    "a an and are best can do does for from good how i in is it list me my of on or should some "
+    "that the to what which with".split()
+)
+
+# Search results, shared by every worker through Redis (or the disk when Redis is absent)
+search_cache = TieredCache(
+    "search",
+    max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 1024)),
+    shared_max_entries=int(os.getenv("SEARCH_CACHE_SHARED_MAX_ENTRIES", 50000)),
+    ttl_seconds=int(os.getenv("SEARCH_CACHE_TTL_SECONDS", 30 * 24 * 3600))
+)
+search_flight = SingleFlight(search_cache)
+
+def _terms(text: str) -> list:
+    return [term for term in re.findall(r"[a-z0-9]+", (text or "").lower()) if term not in STOPWORDS]
+
+def normalize_search_query(query: str) -> str:
+    """
+    Reduces a query to its distinct significant words in sorted order, so near-identical searches
+    ("Foods high in iron", "high-iron foods") share a cache entry.
+    """
+    return " ".join(sorted(set(_terms(query))))
+
+class SerperBackend:
+    """Web search through Serper's API, behind a cluster-wide rate limit."""
+
+    name = "serper"
+
+    def __init__(self):
+        self.api_key = os.getenv("SERPER_API_KEY", "")
+        self.limiter = RateLimiter(
+            "search:serper", SEARCH_REQUESTS_PER_MINUTE, SEARCH_BURST, SEARCH_MAX_CONCURRENCY,
+            wait_metric="search_rate_limit_wait_seconds"
+        )
+
+    def search(self, query: str) -> str:
+        request = urllib.request.Request(
+            SERPER_URL,
+            data=json.dumps({"q": query, "num": SEARCH_RESULTS}).encode(),
+            headers={"X-API-KEY": self.api_key, "Content-Type": "application/json"},
+        )
+
+        def post():
+            with self.limiter.slot():
+                with urllib.request.urlopen(request, timeout=SEARCH_TIMEOUT_SECONDS) as response:
+                    return json.load(response)
+
+        # Rate limits, 5xx responses and connection errors are retried with backoff, like LLM calls
+        results = call_with_backoff(post, max_retries=SEARCH_MAX_RETRIES, metric="search")
+        return json.dumps(results, ensure_ascii=False)
+
+class LocalKnowledgeBackend:
+    """
+    Offline search over a JSON list of {"id", "title", "snippet"} documents, ranked by TF-IDF cosine
+    similarity. Results have the shape of Serper's, so agents cannot tell the two apart.
+    """
+
+    name = "local"
+
+    def __init__(self, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            self.documents = json.load(f)
+        term_counts = [Counter(_terms(f"{doc['title']} {doc['title']} {doc['snippet']}")) for doc in self.documents]
+        document_frequency = Counter(term for counts in term_counts for term in counts)
+        self.idf = {term: math.log(len(self.documents) / count) + 1 for term, count in document_frequency.items()}
+        self.vectors = [self._weigh(counts) for counts in term_counts]
+
+    def _weigh(self, counts: Counter) -> dict:
+        vector = {term: count * self.idf.get(term, 0) for term, count in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1
+        return {term: weight / norm for term, weight in vector.items()}
+
+    def search(self, query: str) -> str:
+        query_vector = self._weigh(Counter(_terms(query)))
+        scored = sorted(
+            ((sum(weight * vector.get(term, 0) for term, weight in query_vector.items()), position)
+             for position, vector in enumerate(self.vectors)),
+            reverse=True
+        )
+        organic = [
+            {
+                "title": self.documents[position]["title"],
+                "link": f"knowledge://{self.documents[position]['id']}",
+                "snippet": self.documents[position]["snippet"],
+                "position": rank + 1,
+            }
+            for rank, (score, position) in enumerate(item for item in scored[:SEARCH_RESULTS] if item[0] > 0)
+        ]
+        return json.dumps({"searchParameters": {"q": query, "source": "local knowledge index"}, "organic": organic})
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_search_backend():
+    """Returns the backend configured by SEARCH_BACKEND, created on first use."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if SEARCH_BACKEND == "serper":
+                _backend = SerperBackend()
+            elif SEARCH_BACKEND == "local":
+                _backend = LocalKnowledgeBackend(SEARCH_KNOWLEDGE_PATH)
+            else:
+                raise ValueError(f"Unknown SEARCH_BACKEND '{SEARCH_BACKEND}', expected 'serper' or 'local'.")
+    return _backend
+
+def cached_search(query: str) -> str:
+    """
+    Searches through the shared cache. Concurrent identical searches, in this process or on other
+    workers, wait for a single backend call instead of each making their own.
+    """
+    backend = get_search_backend()
+    key = make_cache_key({"backend": backend.name, "query": normalize_search_query(query)})
+
+    def search():
+        record("search_calls")
+        with timed("search"):
+            return backend.search(query)
+
+    results, computed = search_flight.do(key, search)
+    if not computed:
+        record("search_cache_hits")
+    return results
+
+class SearchToolInput(BaseModel):
+    search_query: str = Field(..., description="What to search for, e.g. 'foods high in iron'")
+
+class CachedSearchTool(BaseTool):
+    name: str = "Search Tool"
+    description: str = (
+        "Searches trusted health guidance for a topic (foods rich in a nutrient, safe exercise for a condition) "
+        "and returns the top results with a title and snippet each."
+    )
+    args_schema: Type[BaseModel] = SearchToolInput
+
+    def _run(self, search_query: str) -> str:
+        try:
+            return cached_search(search_query)
+        except Exception as e:
+            # Errors are returned to the agent, and never cached
+            logger.error(f"Search failed for '{search_query}': {e}")
+            return f"The search failed: {e}. Continue with what you already know."
@@ -0,0 +1,8 @@
+# tests/conftest.py
+import os
+import sys
+
+# The modules live at the repository root, next to main.py and worker.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# database.py (imported by trends.py) names its database on import; the client connects lazily, so no Mongo is needed
+os.environ.setdefault("MONGO_DB_NAME", "tests")
@@ -0,0 +1,95 @@
+# tests/test_analytes.py
+from datetime import datetime
+import pytest
+from analytes import parse_analytes, parse_reference_range, lookup_analyte, is_blood_report, analyte_values, collection_date
+
+REPORT = """Patient Name : Test Patient
+Collected : 14/5/2023 11:03:00AM
+Test Name Result Unit Bio. Ref. Interval
+Hemoglobin 11.2 g/dL 13.00 - 17.00
+Packed Cell Volume (PCV) 44 % 40 - 50
+Total Cholesterol 230 mg/dL <200.00
+HDL Cholesterol 45 mg/dL >40
+A : G Ratio 1.33 0.90 - 2.00
+Interpretation: values outside the reference interval are flagged
+"""
+
+def by_name(records: list) -> dict:
+    return {record["name"]: record for record in records}
+
+def test_text_lines_become_records():
+    records = by_name(parse_analytes(REPORT))
+    assert set(records) == {"Hemoglobin", "Packed Cell Volume (PCV)", "Total Cholesterol", "HDL Cholesterol", "A : G Ratio"}
+    assert records["Hemoglobin"] == {
+        "name": "Hemoglobin", "analyte": "Hemoglobin", "value": 11.2, "unit": "g/dL", "low": 13.0, "high": 17.0, "flag": "LOW",
+    }
+
+@pytest.mark.parametrize("name, low, high, flag", [
+    ("Total Cholesterol", None, 200.0, "HIGH"),
+    ("HDL Cholesterol", 40.0, None, "NORMAL"),
+    ("Packed Cell Volume (PCV)", 40.0, 50.0, "NORMAL"),
+])
+def test_one_sided_and_two_sided_ranges(name, low, high, flag):
+    record = by_name(parse_analytes(REPORT))[name]
+    assert (record["low"], record["high"], record["flag"]) == (low, high, flag)
+
+def test_values_without_a_unit():
+    record = by_name(parse_analytes(REPORT))["A : G Ratio"]
+    assert (record["analyte"], record["unit"], record["value"]) == ("A:G Ratio", None, 1.33)
+
+@pytest.mark.parametrize("printed, canonical", [
+    ("Haemoglobin", "Hemoglobin"),
+    ("Packed Cell Volume (PCV)", "Hematocrit"),
+    ("AST (SGOT)", "AST"),
+    ("Vitamin D, 25 - Hydroxy, Serum", "Vitamin D"),
+    ("Creatinine, Serum", "Creatinine"),
+    ("Unlisted Marker", None),
+])
+def test_printed_names_map_to_canonical_analytes(printed, canonical):
+    assert lookup_analyte(printed) == canonical
+
+@pytest.mark.parametrize("text, bounds", [
+    ("13.00 - 17.00", (13.0, 17.0)),
+    ("<200.00", (None, 200.0)),
+    (">= 40", (40.0, None)),
+    ("see note", (None, None)),
+    (None, (None, None)),
+])
+def test_reference_ranges(text, bounds):
+    assert parse_reference_range(text) == bounds
+
+def test_unknown_tests_are_kept_without_an_analyte():
+    records = parse_analytes("Special Marker 5 units 1 - 10")
+    assert records == [{"name": "Special Marker", "analyte": None, "value": 5.0, "unit": "units", "low": 1.0, "high": 10.0, "flag": "NORMAL"}]
+
+def test_table_rows_are_preferred_and_duplicates_dropped():
+    tables = [[
+        ["Test", "Result", "Unit", "Reference"],
+        ["Hemoglobin\nPhotometry", "11.2", "g/dL", "13.00 - 17.00"],
+        ["Neutrophils\nLymphocytes", "60\n30", "%\n%", "40 - 80\n20 - 40"],
+    ]]
+    records = parse_analytes("Hemoglobin 11.2 g/dL 13.00 - 17.00", tables)
+    # The method line is dropped from the name, and the same result read from the text is not repeated
+    assert [record["name"] for record in records] == ["Hemoglobin"]
+
+def test_lines_that_are_not_results_are_ignored():
+    assert parse_analytes("Page 1 of 2\nRemarks: fasting sample\nHemoglobin pending") == []
+
+def test_blood_reports_need_enough_recognized_analytes():
+    records = parse_analytes(REPORT)
+    assert is_blood_report(records)
+    assert not is_blood_report(records[:2])
+    assert not is_blood_report(parse_analytes("Special Marker 5 units 1 - 10\nOther Marker 3 units 1 - 10\nThird Marker 2 units 1 - 10"))
+
+def test_history_values_list_each_canonical_analyte_once():
+    records = parse_analytes("Hemoglobin 11.2 g/dL 13.00 - 17.00\nHb 11.4 g/dL 13.00 - 17.00\nSpecial Marker 5 units 1 - 10")
+    assert analyte_values(records) == [{"analyte": "Hemoglobin", "value": 11.2, "unit": "g/dL", "low": 13.0, "high": 17.0}]
+
+@pytest.mark.parametrize("text, date", [
+    (REPORT, datetime(2023, 5, 14)),
+    ("Sample Date: 2023-05-14", datetime(2023, 5, 14)),
+    ("Collected : 31/2/2023", None),
+    ("Reported : 14/5/2023", None),
+])
+def test_collection_dates(text, date):
+    assert collection_date(text) == date
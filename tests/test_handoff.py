@@ -0,0 +1,47 @@
+# tests/test_handoff.py
+import pytest
+import handoff
+from handoff import fit_to_budget, trim_to_tokens
+
+@pytest.fixture(autouse=True)
+def one_token_per_character(monkeypatch):
+    # Keeps the budgets exact and independent of the tokenizer LiteLLM ships
+    monkeypatch.setattr(handoff, "count_tokens", len)
+
+def lines(count: int, width: int = 9) -> str:
+    return "\n".join(f"{index:0{width}d}" for index in range(count))
+
+def kept(text: str) -> str:
+    return text.split("\n[... trimmed")[0]
+
+def test_trim_keeps_text_within_budget():
+    text = lines(3)
+    assert trim_to_tokens(text, len(text)) is text
+
+def test_trim_keeps_whole_lines_and_marks_the_cut():
+    text = lines(10)
+    trimmed = trim_to_tokens(text, 35)
+    assert kept(trimmed) == lines(3)
+    assert trimmed.endswith(f"[... trimmed {len(text) - 35} tokens to fit the context budget]")
+
+def test_outputs_within_budget_are_returned_untouched():
+    outputs = {"doctor": lines(2), "nutrition": lines(3)}
+    assert fit_to_budget(outputs, 1000) is outputs
+
+def test_short_outputs_give_their_share_to_long_ones():
+    outputs = {"doctor": lines(1), "nutrition": lines(30), "exercise": lines(2)}
+    fitted = fit_to_budget(outputs, 200)
+    assert fitted["doctor"] == outputs["doctor"]
+    assert fitted["exercise"] == outputs["exercise"]
+    # 200 tokens less the 9 + 19 the short outputs take, in whole lines of 10
+    assert kept(fitted["nutrition"]) == lines(17)
+
+def test_long_outputs_are_trimmed_to_equal_shares():
+    outputs = {"nutrition": lines(30), "exercise": lines(40)}
+    fitted = fit_to_budget(outputs, 100)
+    assert kept(fitted["nutrition"]) == kept(fitted["exercise"]) == lines(5)
+    assert all(len(kept(text)) <= 50 for text in fitted.values())
+
+def test_output_order_is_preserved():
+    outputs = {"nutrition": lines(30), "doctor": lines(1)}
+    assert list(fit_to_budget(outputs, 50)) == ["nutrition", "doctor"]
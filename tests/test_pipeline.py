@@ -0,0 +1,41 @@
+# tests/test_pipeline.py
+import pytest
+from pipeline import ANALYSIS_MODES, STAGE_GRAPH, prune_stages, stage_levels, final_stage
+
+def test_full_mode_keeps_the_whole_graph():
+    assert prune_stages(STAGE_GRAPH, "full") == STAGE_GRAPH
+    assert prune_stages(STAGE_GRAPH) == STAGE_GRAPH
+
+def test_summary_mode_runs_only_the_doctor():
+    pruned = prune_stages(STAGE_GRAPH, "summary")
+    assert pruned == {"doctor": []}
+    assert stage_levels(pruned) == [["doctor"]]
+    assert final_stage(pruned) == "doctor"
+
+@pytest.mark.parametrize("mode, specialist", [("nutrition", "nutrition"), ("fitness", "exercise")])
+def test_specialist_modes_skip_the_compiler_and_the_other_specialist(mode, specialist):
+    pruned = prune_stages(STAGE_GRAPH, mode)
+    assert pruned == {"doctor": [], specialist: ["doctor"]}
+    assert stage_levels(pruned) == [["doctor"], [specialist]]
+    assert final_stage(pruned) == specialist
+
+def test_every_mode_targets_stages_of_the_graph():
+    for mode, targets in ANALYSIS_MODES.items():
+        assert set(targets) <= set(prune_stages(STAGE_GRAPH, mode))
+
+def test_pruning_keeps_declaration_order(monkeypatch):
+    monkeypatch.setattr("pipeline.ANALYSIS_MODES", dict(ANALYSIS_MODES, custom=["d"]))
+    graph = {"a": [], "b": ["a"], "c": [], "d": ["c", "a"]}
+    assert list(prune_stages(graph, "custom")) == ["a", "c", "d"]
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError, match="Unknown analysis mode"):
+        prune_stages(STAGE_GRAPH, "everything")
+
+def test_full_graph_levels_run_the_specialists_together():
+    assert stage_levels(STAGE_GRAPH) == [["doctor"], ["nutrition", "exercise"], ["compile"]]
+    assert final_stage(STAGE_GRAPH) == "compile"
+
+def test_circular_dependencies_are_rejected():
+    with pytest.raises(ValueError, match="circular"):
+        stage_levels({"doctor": [], "nutrition": ["exercise"], "exercise": ["nutrition"]})
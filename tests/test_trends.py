@@ -0,0 +1,93 @@
+# tests/test_trends.py
+from datetime import datetime, timedelta
+import pytest
+from trends import NO_HISTORY, compute_trends, summarize_trends
+
+START = datetime(2022, 1, 1)
+YEAR = timedelta(days=365.25)
+
+def reading(value, years=0.0, analyte="Hemoglobin", unit="g/dL", low=13.0, high=17.0):
+    return {"analyte": analyte, "unit": unit, "taken_at": START + years * YEAR, "value": value, "low": low, "high": high}
+
+def by_analyte(trends: list) -> dict:
+    return {(trend["analyte"], trend["unit"]): trend for trend in trends}
+
+def test_no_readings_have_no_trends():
+    assert compute_trends([]) == []
+
+def test_slope_is_per_year_whatever_the_input_order():
+    trends = compute_trends([reading(14.0, 2), reading(10.0, 0), reading(12.0, 1)])
+    assert len(trends) == 1
+    assert trends[0]["slope_per_year"] == pytest.approx(2.0)
+    assert trends[0]["first_taken_at"] == START
+    assert trends[0]["latest_taken_at"] == START + 2 * YEAR
+
+def test_slope_is_least_squares_over_uneven_spacing():
+    # Best fit through (0, 15), (0.5, 14), (2, 12): -19/13 per year, not the -1.5 of its end points
+    trends = compute_trends([reading(15.0, 0), reading(14.0, 0.5), reading(12.0, 2)])
+    assert trends[0]["slope_per_year"] == pytest.approx(-19 / 13, abs=1e-4)
+
+def test_no_slope_without_a_time_span():
+    single, same_day = compute_trends([reading(14.0)]), compute_trends([reading(14.0), reading(15.0)])
+    assert single[0]["slope_per_year"] is None
+    assert single[0]["previous"] is None and single[0]["change"] is None
+    assert same_day[0]["slope_per_year"] is None
+
+def test_change_since_the_previous_reading():
+    trend = compute_trends([reading(10.0, 0), reading(16.0, 1), reading(12.0, 2)])[0]
+    assert (trend["latest"], trend["previous"]) == (12.0, 16.0)
+    assert trend["previous_taken_at"] == START + YEAR
+    assert trend["change"] == pytest.approx(-4.0)
+    assert trend["change_percent"] == pytest.approx(-25.0)
+
+def test_each_analyte_and_unit_is_its_own_series():
+    trends = by_analyte(compute_trends([
+        reading(14.0, 0), reading(15.0, 1),
+        reading(140.0, 0, unit="g/L", low=130.0, high=170.0),
+        reading(90.0, 0, analyte="LDL Cholesterol", unit="mg/dL", low=None, high=100.0),
+        reading(130.0, 1, analyte="LDL Cholesterol", unit="mg/dL", low=None, high=100.0),
+    ]))
+    assert set(trends) == {("Hemoglobin", "g/dL"), ("Hemoglobin", "g/L"), ("LDL Cholesterol", "mg/dL")}
+    assert trends[("Hemoglobin", "g/dL")]["slope_per_year"] == pytest.approx(1.0)
+    assert trends[("Hemoglobin", "g/L")]["readings"] == 1
+    assert trends[("LDL Cholesterol", "mg/dL")]["slope_per_year"] == pytest.approx(40.0)
+
+def test_out_of_range_streaks():
+    trend = compute_trends([reading(v, years) for years, v in enumerate([12.0, 11.0, 12.5, 14.0, 18.0, 19.0])])[0]
+    assert trend["flag"] == "HIGH"
+    assert trend["out_of_range_streak"] == 2
+    assert trend["longest_out_of_range_streak"] == 3
+
+def test_streaks_do_not_run_across_series():
+    trends = by_analyte(compute_trends([
+        reading(11.0, 0, analyte="Hemoglobin"), reading(12.0, 1, analyte="Hemoglobin"),
+        reading(14.0, 0, analyte="MCHC", low=31.5, high=34.5),
+    ]))
+    assert trends[("Hemoglobin", "g/dL")]["out_of_range_streak"] == 2
+    assert trends[("MCHC", "g/dL")]["out_of_range_streak"] == 1
+    assert trends[("MCHC", "g/dL")]["flag"] == "LOW"
+
+def test_missing_bounds_never_flag():
+    trend = compute_trends([reading(5.0, low=None, high=None)])[0]
+    assert trend["flag"] is None
+    assert trend["out_of_range_streak"] == 0
+
+def test_summary_without_earlier_readings():
+    assert summarize_trends(compute_trends([reading(14.0)])) == NO_HISTORY
+
+def test_summary_lists_long_standing_results_first_and_caps_its_length():
+    trends = compute_trends([
+        reading(14.0, 0), reading(16.0, 1),
+        reading(90.0, 0, analyte="LDL Cholesterol", unit="mg/dL", low=None, high=100.0),
+        reading(120.0, 0.5, analyte="LDL Cholesterol", unit="mg/dL", low=None, high=100.0),
+        reading(130.0, 1, analyte="LDL Cholesterol", unit="mg/dL", low=None, high=100.0),
+        reading(5.0, 0, analyte="TSH", unit="µIU/mL", low=0.55, high=4.78),
+        reading(2.0, 1, analyte="TSH", unit="µIU/mL", low=0.55, high=4.78),
+    ])
+    lines = summarize_trends(trends, max_lines=2).splitlines()
+    assert lines[0].startswith("- LDL Cholesterol: 130 mg/dL HIGH")
+    assert "out of range in the last 2 reports" in lines[0]
+    assert "/year over 3 reports" in lines[0]
+    # Then the largest change: TSH fell 60%, hemoglobin rose 14%
+    assert lines[1].startswith("- TSH: 2 µIU/mL on")
+    assert lines[2] == "(1 more tests with earlier results not listed)"
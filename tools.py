@@ -1,74 +1,81 @@
 import os
 import logging
-import time
-import pdfplumber
 from dotenv import load_dotenv
 from litellm import completion
-from crewai_tools import SerperDevTool
 from crewai.tools.base_tool import BaseTool
+from cache import TieredCache, make_cache_key
+from metrics import record
+from rate_limiter import llm_limiter, call_with_backoff, TransientLLMError, LLM_MAX_RETRIES
+from search import CachedSearchTool
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-# Search Tool
-search_tool = SerperDevTool()
+# Search Tool: cached and deduplicated across workers, backed by Serper or the local knowledge index
+search_tool = CachedSearchTool()
+
+# Memoized LLM responses, shared by every worker through Redis (or the disk when Redis is absent)
+llm_cache = TieredCache(
+    "llm",
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1024)),
+    shared_max_entries=int(os.getenv("LLM_CACHE_SHARED_MAX_ENTRIES", 100000)),
+    ttl_seconds=int(os.getenv("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+)
+
+def llm_cache_key(model, messages):
+    """Keys a completion on the model and the messages, ignoring key order and surrounding whitespace."""
+    canonical_messages = [
+        {**message, "content": message["content"].strip()} if isinstance(message.get("content"), str) else message
+        for message in messages
+    ]
+    return make_cache_key({"model": model, "messages": canonical_messages})
 
 # --- Helper function for robust LLM calls with retries ---
-def llm_completion_with_retry(model, messages, api_key, max_retries=2, delay=5):
+def llm_completion_with_retry(model, messages, api_key, max_retries=LLM_MAX_RETRIES):
     """
     Calls the LLM with retry logic for handling transient errors like rate limiting.
+    Calls share the cluster-wide limiter for the API key and back off exponentially with jitter.
+    Successful responses are memoized; error messages are never cached.
     """
-    for attempt in range(max_retries):
-        try:
+    cache_key = llm_cache_key(model, messages)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"LLM cache hit for {model}.")
+        record("llm_cache_hits")
+        return cached
+
+    limiter = llm_limiter(api_key)
+
+    def complete():
+        with limiter.slot():
             response = completion(
                 model=model,
                 messages=messages,
                 api_key=api_key
             )
-            # Check if the response is valid and has content
-            if response and response.choices and response.choices[0].message.content:
-                return response.choices[0].message.content
-            else:
-                logger.warning(f"LLM call attempt {attempt + 1} returned an empty response. Retrying in {delay} seconds...")
-                time.sleep(delay)
-        except Exception as e:
-            logger.error(f"An exception occurred on LLM call attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying in {delay} seconds...")
-                time.sleep(delay)
-            else:
-                return f"An error occurred after multiple retries: {e}"
-    return "LLM call failed after multiple retries, returning an empty response."
-
-
-# Blood Test Report Tool
-class BloodTestReportTool(BaseTool):
-    name: str = "Blood Test Report Reading Tool"
-    description: str = "Reads and extracts all text content from a blood test report PDF. The input must be a valid file path to the PDF."
+        record("llm_calls")
+        usage = getattr(response, "usage", None)
+        if usage:
+            record("llm_prompt_tokens", usage.prompt_tokens or 0)
+            record("llm_completion_tokens", usage.completion_tokens or 0)
+        # Check if the response is valid and has content
+        if response and response.choices and response.choices[0].message.content:
+            return response.choices[0].message.content
+        raise TransientLLMError("The LLM returned an empty response.")
 
-    def _run(self, file_path: str) -> str:
-        try:
-            logger.info(f"Processing file: {file_path}")
-            if not os.path.exists(file_path):
-                return f"Error: File not found at path {file_path}. Please ensure the correct path is provided."
+    try:
+        content = call_with_backoff(complete, max_retries=max_retries)
+    except TransientLLMError:
+        return "LLM call failed after multiple retries, returning an empty response."
+    except Exception as e:
+        logger.error(f"LLM call failed: {e}")
+        return f"An error occurred after multiple retries: {e}"
 
-            with pdfplumber.open(file_path) as pdf:
-                text = ""
-                for page in pdf.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
-            
-            if not text.strip():
-                return "Error: No text could be extracted from the PDF. The file might be empty, corrupted, or contain only images."
+    llm_cache.set(cache_key, content)
+    return content
 
-            logger.info(f"Successfully extracted text from {file_path}.")
-            return text
-        except Exception as e:
-            logger.error(f"Error in BloodTestReportTool while processing {file_path}: {e}", exc_info=True)
-            return f"Error reading or processing the PDF file: {e}. The file might be encrypted or malformed."
 
 # Nutrition Tool
 class NutritionTool(BaseTool):
@@ -111,6 +118,5 @@ class ExerciseTool(BaseTool):
         )
 
 # Instantiate tools
-blood_test_tool = BloodTestReportTool()
 nutrition_tool = NutritionTool()
 exercise_tool = ExerciseTool()
\ No newline at end of file
@@ -0,0 +1,149 @@
+# trends.py
+import os
+import logging
+import numpy as np
+from dotenv import load_dotenv
+from database import get_analyte_history
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Most analytes listed in the doctor's trend summary: those out of range the longest, then the fastest changing
+TRENDS_MAX_SUMMARY_LINES = int(os.getenv("TRENDS_MAX_SUMMARY_LINES", 12))
+# A yearly slope is only quoted for series spanning at least this long; over shorter spans it is noise
+TRENDS_MIN_SLOPE_SPAN_DAYS = int(os.getenv("TRENDS_MIN_SLOPE_SPAN_DAYS", 60))
+SECONDS_PER_YEAR = 365.25 * 24 * 3600
+
+NO_HISTORY = "No earlier reports are on file for this patient."
+
+def _bounds(readings: list, key: str) -> np.ndarray:
+    # A missing bound is NaN, which never compares as out of range
+    return np.array([np.nan if reading.get(key) is None else reading[key] for reading in readings], dtype=float)
+
+def _number(value):
+    return None if np.isnan(value) else round(float(value), 4)
+
+def compute_trends(readings: list) -> list:
+    """
+    Computes the trend of every series (one analyte in one unit) in a patient's readings, all series in
+    one vectorized pass: the latest and previous values and the change between them, the least-squares
+    slope per year, and how many consecutive readings up to the latest, and at most, were out of range.
+    Each reading is a dict with analyte, unit, taken_at, value, low and high, as stored by database.py.
+    Returns one dict per series, ordered by analyte.
+    """
+    if not readings:
+        return []
+    series = np.array([f"{reading['analyte']}\x1f{reading.get('unit') or ''}" for reading in readings])
+    names, codes = np.unique(series, return_inverse=True)
+    taken = np.array([reading["taken_at"] for reading in readings], dtype="datetime64[s]").astype(np.float64)
+
+    # Group the readings of each series together, oldest first
+    order = np.lexsort((taken, codes))
+    codes, taken = codes[order], taken[order]
+    values = np.array([reading["value"] for reading in readings], dtype=float)[order]
+    low, high = _bounds(readings, "low")[order], _bounds(readings, "high")[order]
+
+    count = len(codes)
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], count] - 1
+    sizes = ends - starts + 1
+
+    # Change since the previous reading
+    previous = np.where(sizes > 1, values[np.maximum(ends - 1, starts)], np.nan)
+    change = values[ends] - previous
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change_percent = np.where(previous != 0, change / np.abs(previous) * 100, np.nan)
+
+    # Least-squares slope, with time in years since the series' first reading
+    years = (taken - np.repeat(taken[starts], sizes)) / SECONDS_PER_YEAR
+    sum_t, sum_v = np.add.reduceat(years, starts), np.add.reduceat(values, starts)
+    sum_tt, sum_tv = np.add.reduceat(years * years, starts), np.add.reduceat(years * values, starts)
+    denominator = sizes * sum_tt - sum_t * sum_t
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.where(denominator > 0, (sizes * sum_tv - sum_t * sum_v) / denominator, np.nan)
+
+    # Out-of-range streaks: distance from each reading back to the last in-range one of its series
+    index = np.arange(count)
+    out_of_range = (values < low) | (values > high)
+    floor = np.full(count, -1)
+    floor[starts] = starts - 1
+    last_in_range = np.maximum.accumulate(np.maximum(np.where(out_of_range, -1, index), floor))
+    streak = index - last_in_range
+    longest_streak = np.maximum.reduceat(streak, starts)
+
+    latest_flag = np.where(values[ends] < low[ends], "LOW", np.where(values[ends] > high[ends], "HIGH", "NORMAL"))
+    latest_flag = np.where(np.isnan(low[ends]) & np.isnan(high[ends]), "", latest_flag)
+
+    trends = []
+    for position, code in enumerate(codes[starts]):
+        first, last = order[starts[position]], order[ends[position]]
+        analyte, unit = names[code].split("\x1f")
+        trends.append({
+            "analyte": analyte,
+            "unit": unit or None,
+            "readings": int(sizes[position]),
+            "first_taken_at": readings[first]["taken_at"],
+            "latest_taken_at": readings[last]["taken_at"],
+            "latest": float(values[ends[position]]),
+            "previous": _number(previous[position]),
+            "previous_taken_at": readings[order[ends[position] - 1]]["taken_at"] if sizes[position] > 1 else None,
+            "change": _number(change[position]),
+            "change_percent": _number(change_percent[position]),
+            "slope_per_year": _number(slope[position]),
+            "low": _number(low[ends[position]]),
+            "high": _number(high[ends[position]]),
+            "flag": str(latest_flag[position]) or None,
+            "out_of_range_streak": int(streak[ends[position]]),
+            "longest_out_of_range_streak": int(longest_streak[position]),
+        })
+    return trends
+
+def _trend_line(trend: dict) -> str:
+    unit = f" {trend['unit']}" if trend["unit"] else ""
+    flag = f" {trend['flag']}" if trend["flag"] and trend["flag"] != "NORMAL" else ""
+    line = (
+        f"- {trend['analyte']}: {trend['latest']:g}{unit}{flag} on {trend['latest_taken_at']:%Y-%m-%d}, "
+        f"was {trend['previous']:g} on {trend['previous_taken_at']:%Y-%m-%d} ({trend['change']:+g}"
+    )
+    line += f", {trend['change_percent']:+.0f}%)" if trend["change_percent"] is not None else ")"
+    span_days = (trend["latest_taken_at"] - trend["first_taken_at"]).days
+    if trend["readings"] > 2 and trend["slope_per_year"] is not None and span_days >= TRENDS_MIN_SLOPE_SPAN_DAYS:
+        line += f"; {trend['slope_per_year']:+.3g}{unit}/year over {trend['readings']} reports"
+    if trend["out_of_range_streak"] > 1:
+        line += f"; out of range in the last {trend['out_of_range_streak']} reports"
+    return line
+
+def summarize_trends(trends: list, max_lines: int = TRENDS_MAX_SUMMARY_LINES) -> str:
+    """
+    Renders the trends of the series with earlier readings as one short line each, for the doctor:
+    the longest-standing out-of-range results first, then the largest changes.
+    """
+    with_history = [trend for trend in trends if trend["readings"] > 1]
+    if not with_history:
+        return NO_HISTORY
+    with_history.sort(key=lambda trend: (-trend["out_of_range_streak"], -abs(trend["change_percent"] or 0)))
+    lines = [_trend_line(trend) for trend in with_history[:max_lines]]
+    if len(with_history) > max_lines:
+        lines.append(f"({len(with_history) - max_lines} more tests with earlier results not listed)")
+    return "\n".join(lines)
+
+def report_trend_summary(patient_id: str, file_hash: str, taken_at, values: list) -> str:
+    """
+    Summarizes how the patient's results have changed up to a report being analysed, from the stored
+    history of their earlier reports and the report's own values. The earlier reports are never re-read.
+    """
+    # Reports collected after this one (uploaded out of order) are not part of its history
+    history = [
+        reading for reading in get_analyte_history(patient_id, exclude_file_hash=file_hash)
+        if reading["taken_at"] <= taken_at
+    ]
+    if not history:
+        return NO_HISTORY
+    current = [dict(value, taken_at=taken_at) for value in values]
+    trends = compute_trends(history + current)
+    # Only the analytes on this report are of interest to its analysis
+    on_report = {(value["analyte"], value["unit"]) for value in values}
+    summary = summarize_trends([trend for trend in trends if (trend["analyte"], trend["unit"]) in on_report])
+    logger.info(f"Patient {patient_id}: trends computed from {len(history)} earlier reading(s).")
+    return summary
@@ -1,70 +1,322 @@
 # worker.py
 import os
 import logging
-from celery import Celery
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from celery import chain, group
+from celery.signals import worker_init
 from dotenv import load_dotenv
-from crewai import Crew, Process
 
 # Load environment variables
 load_dotenv()
 # print(f"--- DEBUG: Loaded REDIS_URL is: '{os.getenv('REDIS_URL')}' ---")
 
-# Import your agents and tasks
-from agents import verifier, doctor, nutritionist, exercise_specialist, compiler_agent
-from task import verification, help_patients, nutrition_analysis, exercise_planning, compile_report_task
-from database import update_analysis_task
+# The pipeline stages (agents, tools, CrewAI, LiteLLM) are imported lazily, see get_pipeline_stages
+from celery_client import celery_app, LANES, PROCESS_REPORT_TASK, RUN_STAGE_TASK, FINISH_REPORT_TASK, COLLECT_BLOBS_TASK
+from pipeline import run_stage, prune_stages, check_stage_graph, stage_levels, final_stage, STAGE_GRAPH, DEFAULT_MODE
+from pdf_extraction import extract_pdf_report
+from analytes import parse_analytes, is_blood_report, summarize_findings, analyte_values, collection_date
+from database import (
+    start_analysis_task, update_analysis_task, resolve_cached_result, update_stage_timing, save_task_metrics,
+    get_task_checkpoint, save_checkpoint, claim_checkpoint, record_analyte_history, extend_cache_claim,
+    ensure_indexes
+)
+from handoff import stage_context, render_findings, patient_facing
+from trends import report_trend_summary, NO_HISTORY
+from blob_store import get_blob_store, release_report, collect_garbage
+from admission import admission, ADMISSION_MAX_WAIT_SECONDS
+from progress import publish_progress
+from metrics import track_task, set_stage, record_stage_duration
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Initialize Celery
-celery_app = Celery(
-    'tasks',
-    broker=os.getenv("REDIS_URL"),
-    backend=os.getenv("REDIS_URL")
-)
+# A failing LLM stage is retried on its own, from its checkpointed inputs, this many times
+STAGE_MAX_RETRIES = int(os.getenv("STAGE_MAX_RETRIES", 2))
+STAGE_RETRY_DELAY_SECONDS = int(os.getenv("STAGE_RETRY_DELAY_SECONDS", 30))
 
-celery_app.conf.update(
-    task_track_started=True,
-    broker_connection_retry_on_startup=True
-)
+@worker_init.connect
+def create_indexes(**kwargs):
+    """Creates the database's indexes once, when the worker starts and before it takes any job."""
+    ensure_indexes()
+
+_pipeline_stages = None
+_idle_pipelines = []
+_pipeline_lock = threading.Lock()
+
+def build_stages() -> dict:
+    """Builds a set of stages, checking that their dependencies are the ones jobs are planned with."""
+    from task import build_pipeline_stages
+    stages = build_pipeline_stages()
+    check_stage_graph(stages)
+    return stages
+
+def get_pipeline_stages() -> dict:
+    """
+    Builds the agents and their tasks on first use and keeps them for the rest of the process.
+    Run stages on a set lent by checkout_pipeline. Only the I/O worker, which runs the stages, builds them.
+    """
+    global _pipeline_stages
+    with _pipeline_lock:
+        if _pipeline_stages is None:
+            _pipeline_stages = build_stages()
+            _idle_pipelines.append(_pipeline_stages)
+            logging.info(f"Pipeline built with stages: {', '.join(_pipeline_stages)}")
+    return _pipeline_stages
+
+@contextmanager
+def checkout_pipeline():
+    """
+    Lends the caller a set of stages no other job is using, building another set only when all are busy.
+    CrewAI tasks and agents keep per-run state, so jobs running side by side in a thread pool must not share them.
+    """
+    get_pipeline_stages()
+    with _pipeline_lock:
+        stages = _idle_pipelines.pop() if _idle_pipelines else None
+    if stages is None:
+        stages = build_stages()
+    try:
+        yield stages
+    finally:
+        with _pipeline_lock:
+            _idle_pipelines.append(stages)
+
+def stage_started(task_id: str, stage: str, started_at: datetime):
+    """Records and publishes the start of a stage, and attributes the metrics recorded from here on to it."""
+    set_stage(stage)
+    update_stage_timing(task_id, stage, started_at)
+    publish_progress(task_id, {"type": "stage", "stage": stage, "state": "started", "at": started_at.isoformat()})
+
+def stage_finished(task_id: str, stage: str, started_at: datetime, finished_at: datetime):
+    """Records and publishes the end of a stage."""
+    update_stage_timing(task_id, stage, started_at, finished_at)
+    record_stage_duration(stage, (finished_at - started_at).total_seconds())
+    publish_progress(task_id, {
+        "type": "stage",
+        "stage": stage,
+        "state": "finished",
+        "at": finished_at.isoformat(),
+        "duration_seconds": (finished_at - started_at).total_seconds()
+    })
+
+def finish_task(task_id: str, status: str, result: str, cache_key: str = None, task_metrics=None, started_at=None):
+    """
+    Stores the final status and result, settles any coalesced tasks through the result cache,
+    and pushes the outcome to everyone streaming the progress of these tasks.
+    """
+    if task_metrics is not None:
+        task_metrics.status = status
+        if started_at is not None:
+            task_metrics.job_seconds = (datetime.utcnow() - started_at).total_seconds()
+    update_analysis_task(task_id, status=status, result=result)
+    task_ids = [task_id]
+    if cache_key:
+        task_ids += resolve_cached_result(cache_key, task_id, status=status, result=result)
+
+    event = {"type": "result", "status": status}
+    event["analysis" if status == "COMPLETED" else "error"] = result
+    for settled_id in task_ids:
+        publish_progress(settled_id, event)
+
+def verify_report(task_id: str, file_hash: str):
+    """
+    Validates and parses the report locally, replacing the verifier agent's LLM round-trip.
+    Returns the compact findings structure handed to the doctor, and the report's analyte values
+    with its collection date (None when not printed) for the patient's history.
+    Raises ValueError for non-reports.
+    """
+    started_at = datetime.utcnow()
+    stage_started(task_id, "verification", started_at)
+
+    report = extract_pdf_report(get_blob_store().local_path(file_hash), file_hash)
+    records = parse_analytes(report["text"], report["tables"])
+    if not is_blood_report(records):
+        raise ValueError("The uploaded file is not a valid blood test report: no recognizable test results were found.")
+
+    stage_finished(task_id, "verification", started_at, datetime.utcnow())
+    logging.info(f"Task {task_id}: parsed {len(records)} test results from the report.")
+    analytes = {"file_hash": file_hash, "taken_at": collection_date(report["text"]), "values": analyte_values(records)}
+    return summarize_findings(records), analytes
+
+def stage_workflow(task_id: str, cache_key: str = None, mode: str = DEFAULT_MODE, lane: str = "interactive"):
+    """
+    Builds the chain of LLM stage tasks for a job from the stage graph, pruned to the stages its
+    analysis mode needs: stages that only depend on earlier levels run as a group, and a final step
+    settles the job with the last stage's output. Every step goes to the I/O queue of the job's lane.
+    Planned from STAGE_GRAPH, so the CPU worker never imports CrewAI or the agents.
+    """
+    queue = LANES[lane]["io"]
+    dependencies = prune_stages(STAGE_GRAPH, mode)
+    steps = [
+        run_stage_task.si(task_id, level[0]).set(queue=queue) if len(level) == 1
+        else group(run_stage_task.si(task_id, stage).set(queue=queue) for stage in level)
+        for level in stage_levels(dependencies)
+    ]
+    return chain(*steps, finish_report_task.si(task_id, final_stage(dependencies), cache_key).set(queue=queue))
 
-@celery_app.task(name="process_report_task")
-def process_report_task(task_id: str, file_path: str, query: str):
+def stage_inputs(checkpoint: dict) -> dict:
+    """Rebuilds the inputs interpolated into the stages from a job's checkpoint."""
+    findings = checkpoint["checkpoint"]["findings"]
+    return {
+        'query': checkpoint["query"].strip(),
+        'report_findings': render_findings(findings),
+        'patient_trends': checkpoint["checkpoint"].get("trends") or NO_HISTORY
+    }
+
+def keep_cache_claim(task_id: str, cache_key: str, checkpoint: dict):
+    """
+    Renews the job's claim on its result cache entry as it starts each step, for as long as the rest of
+    the job may still wait in its lane's queues and run, so identical requests keep coalescing onto it.
+    """
+    if cache_key:
+        extend_cache_claim(cache_key, task_id, ADMISSION_MAX_WAIT_SECONDS[checkpoint.get("lane") or "interactive"])
+
+@celery_app.task(name=PROCESS_REPORT_TASK)
+def process_report_task(task_id: str, file_hash: str, query: str, cache_key: str = None):
     """
-    The Celery task that runs the full CrewAI analysis.
+    The entry point of a job, on the CPU queue: fetches the report from the blob store by its hash,
+    validates and parses it, checkpoints the findings, then hands the LLM stages to the I/O queue
+    as a chain of stage tasks.
+    Stage progress and the outcome are pushed to streaming clients as they happen. When a cache_key
+    is given, the outcome is also published to the result cache and every request coalesced onto this job.
+    """
+    logging.info(f"Starting CrewAI task {task_id} for report blob: {file_hash}")
+
+    with track_task() as task_metrics:
+        try:
+            # A redelivered message for a job that has already settled, or whose stages are already queued
+            checkpoint = get_task_checkpoint(task_id)
+            if checkpoint is None or checkpoint["status"] in ("COMPLETED", "FAILED"):
+                logging.info(f"Task {task_id}: already settled, nothing to do.")
+                return
+            if "workflow_queued_at" in (checkpoint.get("checkpoint") or {}):
+                logging.info(f"Task {task_id}: LLM stages already queued, nothing to do.")
+                return
+
+            # Update status to PROCESSING
+            start_analysis_task(task_id)
+            keep_cache_claim(task_id, cache_key, checkpoint)
+            publish_progress(task_id, {"type": "status", "status": "PROCESSING"})
+
+            # A redelivered job that was already parsed goes straight to its stages
+            if "findings" not in (checkpoint.get("checkpoint") or {}):
+                findings, analytes = verify_report(task_id, file_hash)
+                # Reports that do not print a collection date are dated by their upload
+                analytes["taken_at"] = analytes["taken_at"] or checkpoint["created_at"]
+                save_checkpoint(task_id, "analytes", analytes)
+                if checkpoint.get("patient_id"):
+                    # Only a few lines of trends reach the doctor, never the patient's earlier reports
+                    save_checkpoint(task_id, "trends", report_trend_summary(
+                        checkpoint["patient_id"], file_hash, analytes["taken_at"], analytes["values"]
+                    ))
+                save_checkpoint(task_id, "findings", findings)
+
+            # Claimed before queueing: a redelivery after the claim must not queue a second chain of stages
+            if not claim_checkpoint(task_id, "workflow_queued_at", datetime.utcnow()):
+                logging.info(f"Task {task_id}: LLM stages already queued, nothing to do.")
+                return
+            stage_workflow(
+                task_id, cache_key, checkpoint.get("mode") or DEFAULT_MODE, checkpoint.get("lane") or "interactive"
+            ).apply_async()
+            logging.info(f"Task {task_id}: report parsed, LLM stages queued.")
+
+        except Exception as e:
+            logging.error(f"Error in CrewAI task {task_id}: {e}", exc_info=True)
+            # Update status to FAILED with the error message
+            finish_task(task_id, "FAILED", str(e), cache_key, task_metrics)
+
+        finally:
+            # The report is no longer needed once its findings are checkpointed. The blob itself is
+            # deleted by collect_blobs_task once no other job references it.
+            try:
+                release_report(task_id, file_hash)
+            except Exception as e:
+                logging.warning(f"Could not release report blob {file_hash}: {e}")
+
+    save_task_metrics(task_id, task_metrics.as_dict())
+
+@celery_app.task(name=RUN_STAGE_TASK, bind=True, max_retries=STAGE_MAX_RETRIES)
+def run_stage_task(self, task_id: str, stage: str):
     """
-    logging.info(f"Starting CrewAI task {task_id} for file: {file_path}")
-    
+    Runs one LLM stage of a job, on the I/O queue, from the checkpointed findings and the outputs of
+    the stages it depends on, and checkpoints its own output. A stage that already has an output is
+    skipped, so a retried or redelivered job resumes from the last completed stage.
+    """
+    checkpoint = get_task_checkpoint(task_id)
+    if checkpoint is None or checkpoint["status"] in ("COMPLETED", "FAILED"):
+        logging.info(f"Task {task_id}: skipping stage '{stage}', the job is already settled.")
+        return
+    outputs = checkpoint["checkpoint"].get("outputs", {})
+    if stage in outputs:
+        logging.info(f"Task {task_id}: stage '{stage}' already completed, resuming after it.")
+        return
+
+    try:
+        with track_task() as task_metrics:
+            try:
+                keep_cache_claim(task_id, checkpoint.get("cache_key"), checkpoint)
+                with checkout_pipeline() as stages:
+                    # The stage gets the compact handoff of its dependencies' outputs, within the context budget
+                    set_stage(stage)
+                    handed_off = stage_context(
+                        stage,
+                        {dependency: outputs[dependency] for dependency in STAGE_GRAPH[stage]},
+                        checkpoint["checkpoint"]["findings"]
+                    )
+                    output = run_stage(
+                        stages,
+                        stage,
+                        stage_inputs(checkpoint),
+                        handed_off,
+                        on_stage_start=lambda stage, started_at: stage_started(task_id, stage, started_at),
+                        on_stage_end=lambda stage, started_at, finished_at: stage_finished(task_id, stage, started_at, finished_at)
+                    )
+                save_checkpoint(task_id, f"outputs.{stage}", output)
+
+            except Exception as e:
+                if self.request.retries < self.max_retries:
+                    logging.warning(f"Task {task_id}: stage '{stage}' failed ({e}), retrying from its checkpoint.")
+                    raise self.retry(exc=e, countdown=STAGE_RETRY_DELAY_SECONDS)
+                logging.error(f"Error in CrewAI task {task_id}, stage '{stage}': {e}", exc_info=True)
+                # Update status to FAILED; the outputs of the stages that did finish stay checkpointed
+                finish_task(task_id, "FAILED", str(e), checkpoint.get("cache_key"), task_metrics, checkpoint.get("started_at"))
+                raise
+    finally:
+        save_task_metrics(task_id, task_metrics.as_dict())
+
+def save_analyte_history(task_id: str, checkpoint: dict):
+    """Adds a completed report's analyte values to its patient's history, for the trends of later reports."""
+    analytes = checkpoint["checkpoint"].get("analytes")
+    if not checkpoint.get("patient_id") or not analytes:
+        return
     try:
-        # Update status to PROCESSING
-        update_analysis_task(task_id, status="PROCESSING")
-        
-        medical_crew = Crew(
-            agents=[verifier, doctor, nutritionist, exercise_specialist, compiler_agent],
-            tasks=[verification, help_patients, nutrition_analysis, exercise_planning, compile_report_task],
-            process=Process.sequential,
-            verbose=2
+        record_analyte_history(
+            checkpoint["patient_id"], task_id, analytes["file_hash"], analytes["taken_at"], analytes["values"]
         )
-        
-        inputs = {'query': query.strip(), 'file_path': file_path}
-        
-        result = medical_crew.kickoff(inputs=inputs)
-        
+    except Exception as e:
+        # The analysis itself has completed; only later trends miss this report
+        logging.warning(f"Task {task_id}: could not record the analyte history: {e}")
+
+@celery_app.task(name=FINISH_REPORT_TASK)
+def finish_report_task(task_id: str, final_stage_name: str, cache_key: str = None):
+    """Settles a job once all its stages have run, publishing the final stage's output as the result."""
+    checkpoint = get_task_checkpoint(task_id)
+    if checkpoint is None or checkpoint["status"] in ("COMPLETED", "FAILED"):
+        return
+    with track_task() as task_metrics:
+        # The doctor's handoff notes are for the other agents, not the patient
+        result = patient_facing(checkpoint["checkpoint"]["outputs"][final_stage_name])
         logging.info(f"CrewAI task {task_id} completed successfully.")
         # Update status to COMPLETED with the result
-        update_analysis_task(task_id, status="COMPLETED", result=str(result))
-        
-    except Exception as e:
-        logging.error(f"Error in CrewAI task {task_id}: {e}", exc_info=True)
-        # Update status to FAILED with the error message
-        update_analysis_task(task_id, status="FAILED", result=str(e))
-        
-    finally:
-        # Clean up the uploaded file
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-                logging.info(f"Cleaned up file: {file_path}")
-            except OSError as e:
-                logging.warning(f"Could not remove file {file_path}: {e}")
\ No newline at end of file
+        finish_task(task_id, "COMPLETED", str(result), cache_key, task_metrics, checkpoint.get("started_at"))
+        # Feeds the API's wait estimates and admission decisions
+        if task_metrics.job_seconds is not None:
+            admission.record_service_time(checkpoint.get("mode") or DEFAULT_MODE, task_metrics.job_seconds)
+        save_analyte_history(task_id, checkpoint)
+    save_task_metrics(task_id, task_metrics.as_dict())
+
+@celery_app.task(name=COLLECT_BLOBS_TASK)
+def collect_blobs_task():
+    """Deletes the report blobs no job has referenced for a while; scheduled by `celery beat`."""
+    return collect_garbage()